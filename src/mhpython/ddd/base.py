@@ -20,20 +20,87 @@
 #  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
 import abc
+import asyncio
+import base64
+import contextlib
+import contextvars
 import dataclasses
+import datetime
+import functools
+import itertools
+import json
+import time
 import typing
 import uuid
+import weakref
 
 import sqlalchemy.ext.asyncio
-from sqlalchemy import UUID, String, select
+from sqlalchemy import (
+    BigInteger,
+    Column,
+    DateTime,
+    Index,
+    Integer,
+    String,
+    Table,
+    and_,
+    delete,
+    func,
+    insert,
+    or_,
+    select,
+    tuple_,
+    update,
+)
 from sqlalchemy.exc import SQLAlchemyError
-from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
+from sqlalchemy.orm import DeclarativeBase, Mapped, aliased, mapped_column
+
+from mhpython.ddd.cache import DDDBloomFilter, DDDCache, DDDNegativeCache
+from mhpython.ddd.identity_map import DDDIdentityMap
+from mhpython.ddd.uid import DDDUniqueIdentifierType, uuid7
+
+if typing.TYPE_CHECKING:
+    from mhpython.ddd.metrics import DDDMetrics
+    from mhpython.ddd.outbox import DDDOutbox
+    from mhpython.ddd.specification import DDDSpecification
 
 #
 # A type var for a unique identifier
 
 UniqueIdentifier = uuid.UUID
 
+#
+# The entities hydrated during the current load, keyed by model class and uid
+
+_hydration_scope: contextvars.ContextVar[
+    typing.Dict[typing.Tuple[type, UniqueIdentifier], typing.Any] | None
+] = contextvars.ContextVar('_hydration_scope', default=None)
+
+
+@contextlib.contextmanager
+def hydration_scope() -> typing.Iterator[None]:
+    """
+    Share a single entity per uid between all models hydrated within this scope, including
+    related aggregates resolved via DDDRepository.resolve. Nested scopes join the outer one.
+    """
+    if _hydration_scope.get() is not None:
+        yield
+        return
+    token = _hydration_scope.set({})
+    try:
+        yield
+    finally:
+        _hydration_scope.reset(token)
+
+
+#
+# Until when the reads of the current context stay on a primary it wrote to, keyed by the session
+# maker of the primary. Never mutated, writes set a new mapping
+
+_primary_pins: contextvars.ContextVar[typing.Mapping[typing.Any, float]] = (
+    contextvars.ContextVar('_primary_pins', default={})
+)
+
 
 class DDDException(Exception):
     """
@@ -98,16 +165,26 @@ T_DDDValueObject = typing.TypeVar('T_DDDValueObject', bound=DDDValueObject)
 class DDDModel(DeclarativeBase):
     """
     Base class for all persistent entities. The T_DDDEntityModel type var binds Generics to
-    subclasses.
+    subclasses. Every table is indexed on (name, uid), the keyset order of DDDRepository.page,
+    which also serves lookups by name.
     """
 
     __abstract__ = True
     uid: Mapped[str] = mapped_column(
-        UUID(as_uuid=True).with_variant(String(32), 'sqlite'),
+        DDDUniqueIdentifierType(),
         primary_key=True,
         sort_order=-1,  # Make sure uid is the first column
     )
     name: Mapped[str] = mapped_column(String(64))
+    # Maintained by the repository on create and modify, see DDDRepository.changes_since
+    revision: Mapped[int] = mapped_column(BigInteger, nullable=True, index=True)
+    updated_at: Mapped[datetime.datetime] = mapped_column(DateTime, nullable=True)
+
+    def __init_subclass__(cls, **kwargs) -> None:
+        super().__init_subclass__(**kwargs)
+        table = cls.__dict__.get('__table__')
+        if table is not None:
+            Index(f'ix_{table.name}_name_uid', table.c.name, table.c.uid)
 
     def __repr__(self):
         return f'{self.__class__.__name__}(uid={self.uid}, name={self.name})'
@@ -115,6 +192,45 @@ class DDDModel(DeclarativeBase):
 
 T_DDDModel = typing.TypeVar('T_DDDModel', bound=DDDModel)
 
+#
+# A single row holding the last revision, inserted by the first write. Every write transaction
+# of a repository tracking revisions increments it once, the row lock makes concurrent
+# transactions obtain their revisions in commit order
+
+revisions_table = Table(
+    'revisions',
+    DDDModel.metadata,
+    Column('id', Integer, primary_key=True),
+    Column('value', BigInteger, nullable=False),
+)
+
+#
+# Tombstones of removed entities, so that change feeds can report removals
+
+tombstones_table = Table(
+    'tombstones',
+    DDDModel.metadata,
+    Column('aggregate', String(64), primary_key=True),
+    Column('uid', DDDUniqueIdentifierType(), primary_key=True),
+    Column('revision', BigInteger, primary_key=True, index=True),
+    Column('removed_at', DateTime, nullable=False),
+)
+
+
+@dataclasses.dataclass(frozen=True)
+class DDDChange:
+    """
+    A change reported by a change feed. The entity is None if it was removed.
+    """
+
+    revision: int
+    uid: 'UniqueIdentifier'
+    entity: 'DDDEntity | None' = None
+
+    @property
+    def removed(self) -> bool:
+        return self.entity is None
+
 
 class DDDEntity(typing.Generic[T_DDDModel]):
     """
@@ -124,9 +240,11 @@ class DDDEntity(typing.Generic[T_DDDModel]):
     repository: typing.ClassVar['DDDRepository']
 
     def __init__(self, name: str, *args, **kwargs) -> None:
-        self._uid: UniqueIdentifier = uuid.uuid4()
+        self._uid: UniqueIdentifier = uuid7()
         self._name = name
         self._dirty = True
+        # The column values as last persisted, maintained by the repository
+        self._snapshot: typing.Dict[str, typing.Any] | None = None
 
     async def post_create(self) -> None:
         """
@@ -156,6 +274,13 @@ class DDDEntity(typing.Generic[T_DDDModel]):
     def dirty(self) -> bool:
         return self._dirty
 
+    @property
+    def persisted(self) -> bool:
+        """
+        Whether the entity has been persisted, regardless of whether it is still in an identity map
+        """
+        return self._snapshot is not None
+
     @dirty.setter
     def dirty(self, value: bool) -> None:
         self._dirty = value
@@ -208,10 +333,72 @@ class DDDAggregateRoot(DDDEntity[T_DDDModel]):
     async def remove(self) -> None:
         await self.repository.remove(self)
 
+    @classmethod
+    async def save_many(
+        cls, entities: typing.Iterable[typing.Self]
+    ) -> typing.List[typing.Self]:
+        entities = list(entities)
+        await cls.repository.create_many([e for e in entities if e.dirty])
+        return entities
+
 
 T_DDDAggregateRoot = typing.TypeVar('T_DDDAggregateRoot', bound=DDDAggregateRoot)
 
 
+@dataclasses.dataclass(frozen=True)
+class DDDPage(typing.Generic[T_DDDEntity]):
+    """
+    A page of entities. The cursor is opaque and must be passed as-is to fetch the next page, it
+    is None when there are no more pages.
+    """
+
+    entities: typing.List[T_DDDEntity]
+    cursor: str | None = None
+
+
+def starts_with(
+    column: sqlalchemy.ColumnElement[str], prefix: str
+) -> sqlalchemy.ColumnElement[bool]:
+    """
+    Match the values of a column starting with a prefix as a range, prefix <= value < successor,
+    so that an index on the column can be used, unlike with LIKE. The column must collate by code
+    point, as SQLite does by default and PostgreSQL does with the C collation.
+    Args:
+        column: The column
+        prefix: The prefix
+    Returns:
+        The condition
+    """
+    # The successor increments the last character that can be incremented, e.g. abc -> abd
+    successor = prefix.rstrip(chr(0x10FFFF))
+    if successor == '':
+        return column >= prefix
+    last = ord(successor[-1]) + 1
+    # Surrogates are not valid characters, the next one is U+E000
+    successor = successor[:-1] + chr(0xE000 if 0xD800 <= last < 0xE000 else last)
+    return and_(column >= prefix, column < successor)
+
+
+def _instrumented(operation: str) -> typing.Callable:
+    """
+    Measure a repository operation if the repository has metrics
+    Args:
+        operation: The name of the operation
+    """
+
+    def decorator(fn: typing.Callable) -> typing.Callable:
+        @functools.wraps(fn)
+        async def wrapper(self: 'DDDRepository', *args, **kwargs):
+            if self._metrics is None:
+                return await fn(self, *args, **kwargs)
+            with self._metrics.measure(self.model_class.__tablename__, operation):
+                return await fn(self, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
 class DDDRepository(typing.Generic[T_DDDEntity, T_DDDModel], abc.ABC):
     """
     Base class for all repositories
@@ -223,10 +410,47 @@ class DDDRepository(typing.Generic[T_DDDEntity, T_DDDModel], abc.ABC):
 
     entity_class: typing.Type[T_DDDEntity]
     model_class: typing.Type[T_DDDModel]
+    # Maximum number of bound parameters per statement, keeps us well below SQLite limits
+    chunk_size: typing.ClassVar[int] = 500
+    # All live repositories, so that a unit of work can find those sharing its session maker
+    _instances: typing.ClassVar[weakref.WeakSet['DDDRepository']] = weakref.WeakSet()
 
     def __init__(
-        self, session_maker: sqlalchemy.ext.asyncio.async_sessionmaker
+        self,
+        session_maker: sqlalchemy.ext.asyncio.async_sessionmaker,
+        identity_map: DDDIdentityMap | None = None,
+        cache: DDDCache | None = None,
+        read_session_makers: typing.Sequence[
+            sqlalchemy.ext.asyncio.async_sessionmaker
+        ] = (),
+        replica_lag: float = 1.0,
+        outbox: typing.Optional['DDDOutbox'] = None,
+        group_commit: typing.Optional['DDDGroupCommit'] = None,
+        metrics: typing.Optional['DDDMetrics'] = None,
+        negative_cache: DDDNegativeCache | None = None,
+        track_revisions: bool = False,
+        sole_writer: bool = False,
     ) -> None:
+        """
+        Args:
+            session_maker: The session maker of the primary database, used for all writes
+            identity_map: The identity map to use, unbounded by default
+            cache: An optional second-level cache, possibly shared with other repositories. Only
+                get_by_uid reads through it, get_many, list, find, stream and page always query
+                the database. Writes invalidate it.
+            read_session_makers: Session makers of read replicas, used round-robin for reads
+            replica_lag: Seconds after a write during which the reads of the writing context stay
+                on the primary
+            outbox: An optional outbox recording an event for every change
+            group_commit: An optional group commit merging concurrent creates and modifies
+            metrics: Optional metrics to record the latency and statements of operations into
+            negative_cache: An optional cache of uids found not to exist
+            track_revisions: Stamp writes with a revision and tombstone removals, as required by
+                watermark and changes_since. Every write transaction then increments a single
+                shared counter row, which costs a statement and serializes all writers.
+            sole_writer: Declare that no other repository instance or process creates entities
+                of this aggregate, as required by rebuild_membership_filter
+        """
         if self.entity_class is None:
             raise DDDException(
                 code=500, msg='Misconfigured DDDRepository without entity'
@@ -236,79 +460,1032 @@ class DDDRepository(typing.Generic[T_DDDEntity, T_DDDModel], abc.ABC):
                 code=500, msg='Misconfigured DDDRepository without model'
             )
         self._session_maker = session_maker
-        self._identity_map: typing.Dict[UniqueIdentifier, T_DDDEntity] = {}
+        self._identity_map: DDDIdentityMap[UniqueIdentifier, T_DDDEntity] = (
+            identity_map if identity_map is not None else DDDIdentityMap()
+        )
+        self._in_flight: typing.Dict[UniqueIdentifier, asyncio.Future] = {}
+        self._cache = cache
+        self._session_makers = (session_maker, *read_session_makers)
+        self._read_session_makers = itertools.cycle(read_session_makers)
+        self._has_replicas = len(read_session_makers) > 0
+        self._replica_lag = replica_lag
+        self._outbox = outbox
+        self._group_commit = group_commit
+        self._metrics = metrics
+        self._negative_cache = negative_cache
+        self._track_revisions = track_revisions
+        self._sole_writer = sole_writer
+        self._membership: DDDBloomFilter | None = None
+        # The uids created while the membership filter is rebuilt
+        self._rebuilding: typing.Set[UniqueIdentifier] | None = None
+        if metrics is not None:
+            metrics.register(self)
         self.entity_class.repository = self
+        DDDRepository._instances.add(self)
+
+    @property
+    def identity_map(self) -> DDDIdentityMap[UniqueIdentifier, T_DDDEntity]:
+        return self._identity_map
 
+    @property
+    def session_makers(
+        self,
+    ) -> typing.Tuple[sqlalchemy.ext.asyncio.async_sessionmaker, ...]:
+        """
+        The session maker of the primary database followed by those of the read replicas
+        """
+        return self._session_makers
+
+    @_instrumented('get_by_uid')
     async def get_by_uid(self, uid: UniqueIdentifier) -> T_DDDEntity:
+        """
+        Get an entity by its unique identifier. Concurrent misses for the same uid are coalesced
+        into a single load whose result is shared by all callers. Uids rejected by the negative
+        cache or the membership filter are not looked up in persistence.
+        Args:
+            uid: The unique identifier of the entity
+        Returns:
+            The entity
+        Raises:
+            EntityNotFoundException: If the entity does not exist
+        """
+        while True:
+            entity = self._identity_map.lookup(uid)
+            if entity is not None:
+                return entity
+            in_flight = self._in_flight.get(uid)
+            if in_flight is None:
+                break
+            try:
+                return await asyncio.shield(in_flight)
+            except asyncio.CancelledError:
+                if not in_flight.cancelled():
+                    raise
+                # The loading caller was cancelled, try again
+        if self._known_missing(uid):
+            raise EntityNotFoundException()
+        generation = (
+            self._negative_cache.generation if self._negative_cache is not None else 0
+        )
+        in_flight = asyncio.get_running_loop().create_future()
+        self._in_flight[uid] = in_flight
+        try:
+            entity = await self._load(uid)
+            in_flight.set_result(entity)
+            return entity
+        except asyncio.CancelledError:
+            in_flight.cancel()
+            raise
+        except Exception as e:
+            if (
+                isinstance(e, EntityNotFoundException)
+                and self._negative_cache is not None
+            ):
+                self._negative_cache.add(uid, generation)
+            in_flight.set_exception(e)
+            in_flight.exception()  # Mark as retrieved in case nobody else was waiting
+            raise
+        finally:
+            del self._in_flight[uid]
+
+    def _known_missing(self, uid: UniqueIdentifier) -> bool:
+        if self._negative_cache is not None and uid in self._negative_cache:
+            return True
+        return self._membership is not None and uid not in self._membership
+
+    async def rebuild_membership_filter(
+        self, error_rate: float = 0.01, headroom: float = 2.0
+    ) -> DDDBloomFilter:
+        """
+        Rebuild the membership filter from the uid column of the primary database, after which
+        get_by_uid rejects most uids that do not exist without a query. Entities created through
+        this repository are added to the filter. Since entities created by anyone else would be
+        rejected although they exist, the repository must be declared the sole writer.
+        Args:
+            error_rate: The rate of uids that do not exist but are still looked up
+            headroom: Size the filter for this multiple of the current number of rows
+        Returns:
+            The new membership filter
+        Raises:
+            DDDException: If the repository is not declared the sole writer
+        """
+        if not self._sole_writer:
+            raise DDDException(
+                code=500,
+                msg='A membership filter requires a repository declared as sole writer',
+            )
+        self._rebuilding = set()
+        try:
+            async with self._write_session_maker()() as session:
+                rows = (
+                    await session.execute(
+                        select(func.count()).select_from(self.model_class)
+                    )
+                ).scalar_one()
+                membership = DDDBloomFilter(max(int(rows * headroom), 1024), error_rate)
+                result = await session.stream_scalars(
+                    select(self.model_class.uid).execution_options(
+                        yield_per=self.chunk_size
+                    )
+                )
+                async for uid in result:
+                    membership.add(UniqueIdentifier(str(uid)))
+            for uid in self._rebuilding:
+                membership.add(uid)
+            self._membership = membership
+            return membership
+        except SQLAlchemyError as sae:
+            raise DDDException(
+                code=500, msg='Failure rebuilding the membership filter'
+            ) from sae
+        finally:
+            self._rebuilding = None
+
+    def _created(self, uids: typing.Iterable[UniqueIdentifier]) -> None:
+        for uid in uids:
+            if self._negative_cache is not None:
+                self._negative_cache.discard(uid)
+            if self._membership is not None:
+                self._membership.add(uid)
+            if self._rebuilding is not None:
+                self._rebuilding.add(uid)
+
+    async def _load(self, uid: UniqueIdentifier) -> T_DDDEntity:
         try:
-            if uid in self._identity_map:
-                return self._identity_map[uid]
-            async with self._session_maker() as session:
-                model = await session.get(self.model_class, str(uid))
+            async with self._read_session_maker()() as session:
+                if self._cache is not None:
+                    model = await self._cached_model(
+                        session, self.model_class, str(uid)
+                    )
+                else:
+                    model = await session.get(self.model_class, str(uid))
                 if model is None:
                     raise EntityNotFoundException()
-                self._identity_map[uid] = await self.from_model(model)
-                return self._identity_map[uid]
+                return await self._hydrate(model)
         except SQLAlchemyError as sae:
             raise DDDException(code=500, msg='Failure getting the entities') from sae
 
+    async def _cached_model(
+        self,
+        session: sqlalchemy.ext.asyncio.AsyncSession,
+        model_class: typing.Type[DDDModel],
+        uid: str,
+    ) -> DDDModel | None:
+        """
+        Get a model from the second-level cache, loading and caching it on a miss. Models built
+        from cached values are transient, their relationships are resolved the same way.
+        """
+        key = self._cache_key(model_class, uid)
+        values = await self._cache_call(self._cache.get, key)
+        if values is None:
+            version = await self._cache_call(self._cache.version, key)
+            model = await session.get(model_class, uid)
+            if model is not None:
+                await self._cache_call(
+                    self._cache.put, key, version, self._model_values(model)
+                )
+            return model
+        model = model_class(**values)
+        for relationship in model_class.__mapper__.relationships:
+            (column,) = relationship.local_columns
+            if values.get(column.key) is not None:
+                related = await self._cached_model(
+                    session, relationship.mapper.class_, values[column.key]
+                )
+                setattr(model, relationship.key, related)
+        return model
+
+    def _read_session_maker(self) -> sqlalchemy.ext.asyncio.async_sessionmaker:
+        """
+        Pick the session maker for a read. Reads go to the replicas round-robin, unless a unit
+        of work is active or the current context wrote to the primary recently, through any
+        repository, so callers can read their writes. Other callers are not affected.
+        """
+        if (
+            not self._has_replicas
+            or DDDUnitOfWork.current(self._session_maker) is not None
+            or time.monotonic() < _primary_pins.get().get(self._session_maker, 0.0)
+        ):
+            return self._session_maker
+        return next(self._read_session_makers)
+
+    def _write_session_maker(self) -> sqlalchemy.ext.asyncio.async_sessionmaker:
+        """
+        Pick the session maker for a write
+        """
+        return self._session_maker
+
+    async def _cache_call(
+        self, method: typing.Callable[..., typing.Any], *args: typing.Any
+    ) -> typing.Any:
+        """
+        Call a method of the second-level cache, in a worker thread if it blocks on I/O
+        """
+        if self._cache.blocking:
+            return await asyncio.to_thread(method, *args)
+        return method(*args)
+
+    def _pin_primary(self) -> None:
+        """
+        Keep the reads of the current context on the primary for replica_lag seconds
+        """
+        pins = _primary_pins.get()
+        until = time.monotonic() + self._replica_lag
+        if pins.get(self._session_maker, 0.0) < until:
+            _primary_pins.set({**pins, self._session_maker: until})
+
+    async def _written(self, uids: typing.Iterable[UniqueIdentifier]) -> None:
+        self._pin_primary()
+        if self._cache is None:
+            return
+        await self._cache_call(
+            self._cache.invalidate_many,
+            [self._cache_key(self.model_class, uid) for uid in uids],
+        )
+
+    @staticmethod
+    def _cache_key(model_class: typing.Type[DDDModel], uid: typing.Any) -> str:
+        return f'{model_class.__tablename__}:{uid}'
+
+    @_instrumented('get_many')
+    async def get_many(
+        self, uids: typing.Iterable[UniqueIdentifier], missing_ok: bool = False
+    ) -> typing.List[T_DDDEntity]:
+        """
+        Get multiple entities by their unique identifiers. Entities already in the identity map
+        are served from there, all others are fetched using a single IN query per chunk.
+        Args:
+            uids: The unique identifiers of the entities to get
+            missing_ok: Silently omit entities that do not exist rather than raising
+        Returns:
+            The entities in the order of the requested uids
+        Raises:
+            EntityNotFoundException: If any of the entities does not exist and missing_ok is False
+        """
+        uids = list(uids)
+        found: typing.Dict[UniqueIdentifier, T_DDDEntity] = {}
+        for uid in dict.fromkeys(uids):
+            entity = self._identity_map.lookup(uid)
+            if entity is not None:
+                found[uid] = entity
+        misses = list(dict.fromkeys(uid for uid in uids if uid not in found))
+        try:
+            if len(misses) > 0:
+                async with self._read_session_maker()() as session:
+                    with hydration_scope():
+                        for chunk in self._chunks(misses):
+                            models = await session.scalars(
+                                select(self.model_class).where(
+                                    self.model_class.uid.in_(
+                                        [str(uid) for uid in chunk]
+                                    )
+                                )
+                            )
+                            for model in models:
+                                entity = await self._hydrate(model)
+                                found[entity.uid] = entity
+        except SQLAlchemyError as sae:
+            raise DDDException(code=500, msg='Failure getting the entities') from sae
+        missing = [uid for uid in uids if uid not in found]
+        if len(missing) > 0 and not missing_ok:
+            raise EntityNotFoundException(
+                msg=f'{len(missing)} of the specified entities do not exist'
+            )
+        return [found[uid] for uid in uids if uid in found]
+
+    @_instrumented('list')
     async def list(self) -> typing.List[T_DDDEntity]:
         try:
-            async with self._session_maker() as session:
+            async with self._read_session_maker()() as session:
                 models = (await session.scalars(select(self.model_class))).all()
-                return [await self.from_model(m) for m in models]
+                self._hydrated(len(models))
+                with hydration_scope():
+                    return [await self._materialize(m) for m in models]
         except SQLAlchemyError as sae:
             raise DDDException(
                 code=500, msg='Failure listing entities from persistence'
             ) from sae
 
+    async def stream(
+        self, chunk_size: int | None = None
+    ) -> typing.AsyncIterator[T_DDDEntity]:
+        """
+        Stream all entities from persistence, hydrating them chunk by chunk so that memory use
+        remains bounded regardless of the table size. Entities already in the identity map are
+        returned from there. All others are only added to it if the identity map is bounded,
+        such as DDDLRUIdentityMap or DDDWeakIdentityMap, an unbounded map would otherwise end
+        up holding the whole table.
+        Args:
+            chunk_size: The number of rows to fetch per round trip, defaults to chunk_size
+        Yields:
+            The entities in persistence
+        """
+        try:
+            async with self._read_session_maker()() as session:
+                result = await session.stream_scalars(
+                    select(self.model_class).execution_options(
+                        yield_per=chunk_size or self.chunk_size
+                    )
+                )
+                async for models in result.partitions():
+                    with hydration_scope():
+                        entities = [await self._streamed(m) for m in models]
+                    for entity in entities:
+                        yield entity
+        except SQLAlchemyError as sae:
+            raise DDDException(
+                code=500, msg='Failure streaming entities from persistence'
+            ) from sae
+
+    async def page(
+        self,
+        limit: int = 100,
+        cursor: str | None = None,
+        order_by: str = 'uid',
+        filters: typing.Mapping[str, typing.Any] | None = None,
+        prefixes: typing.Mapping[str, str] | None = None,
+    ) -> DDDPage[T_DDDEntity]:
+        """
+        Get a page of entities using keyset pagination, so that the cost of fetching a page does
+        not depend on how far into the table it is.
+        Args:
+            limit: The maximum number of entities on the page
+            cursor: The cursor of the previous page, None for the first page
+            order_by: The column to order by, either 'uid' or 'name'
+            filters: Column values the entities must be equal to
+            prefixes: Column values the entities must start with
+        Returns:
+            The page of entities and the cursor for the next page
+        Raises:
+            EntityInvariantException: If the limit, ordering, filters or cursor are invalid
+        """
+        if limit < 1:
+            raise EntityInvariantException(
+                code=400, msg='Pages must hold at least one entity'
+            )
+        if order_by not in ('uid', 'name'):
+            raise EntityInvariantException(
+                code=400, msg='Pages can only be ordered by uid or name'
+            )
+        uid_col = self.model_class.uid
+        order_col = getattr(self.model_class, order_by)
+        query = select(self.model_class)
+        for key, value in (filters or {}).items():
+            query = query.where(self._column(key) == value)
+        for key, value in (prefixes or {}).items():
+            query = query.where(starts_with(self._column(key), value))
+        if cursor is not None:
+            key, uid = self._decode_cursor(cursor, order_by)
+            if order_by == 'uid':
+                query = query.where(uid_col > uid)
+            else:
+                query = query.where(tuple_(order_col, uid_col) > (key, uid))
+        query = query.order_by(order_col, uid_col).limit(limit)
+        try:
+            async with self._read_session_maker()() as session:
+                models = (await session.scalars(query)).all()
+                with hydration_scope():
+                    entities = [await self._hydrate(m) for m in models]
+        except SQLAlchemyError as sae:
+            raise DDDException(
+                code=500, msg='Failure paging entities from persistence'
+            ) from sae
+        next_cursor = None
+        if len(models) == limit:
+            next_cursor = self._encode_cursor(
+                order_by, getattr(models[-1], order_by), models[-1].uid
+            )
+        return DDDPage(entities=entities, cursor=next_cursor)
+
+    @_instrumented('project')
+    async def project(
+        self,
+        fields: typing.Sequence[str],
+        specification: typing.Optional['DDDSpecification'] = None,
+        limit: int | None = None,
+        as_dict: bool = False,
+    ) -> typing.List[typing.Any]:
+        """
+        Select only some columns into read-only rows using a single query, without building models
+        or entities. Fields of related models are named relationship.column and outer-joined,
+        their values are None where the relationship is not set. Nothing is taken from or added
+        to the identity map or cache, and no hooks are called.
+        Args:
+            fields: The columns to select, e.g. ('uid', 'name', 'network.name')
+            specification: The specification the rows must satisfy
+            limit: The maximum number of rows to return, ordered by uid
+            as_dict: Return dicts instead of named tuples
+        Returns:
+            The rows, as named tuples whose attributes are the fields with dots replaced by
+            underscores or as dicts keyed by the fields
+        Raises:
+            EntityInvariantException: If a field does not exist
+        """
+        columns = []
+        joins: typing.Dict[str, typing.Any] = {}
+        for field in fields:
+            path, _, key = field.rpartition('.')
+            model_class = self.model_class
+            if path != '':
+                relationship = self.model_class.__mapper__.relationships.get(path)
+                if relationship is None:
+                    raise EntityInvariantException(
+                        code=400,
+                        msg=f'{self.model_class.__name__} has no relationship {path}',
+                    )
+                model_class = relationship.mapper.class_
+            if key not in model_class.__table__.columns:
+                raise EntityInvariantException(
+                    code=400, msg=f'{model_class.__name__} has no column {key}'
+                )
+            if path != '':
+                target = joins.setdefault(path, aliased(model_class, name=path))
+            else:
+                target = self.model_class
+            columns.append(getattr(target, key).label(field.replace('.', '_')))
+        query = select(*columns).select_from(self.model_class)
+        for path, target in joins.items():
+            query = query.outerjoin(getattr(self.model_class, path).of_type(target))
+        if specification is not None:
+            query = query.where(specification.compile(self.model_class))
+        if limit is not None:
+            query = query.order_by(self.model_class.uid).limit(limit)
+        try:
+            async with self._read_session_maker()() as session:
+                rows = (await session.execute(query)).all()
+        except SQLAlchemyError as sae:
+            raise DDDException(
+                code=500, msg='Failure projecting entities from persistence'
+            ) from sae
+        if as_dict:
+            return [dict(zip(fields, row)) for row in rows]
+        return rows
+
+    @_instrumented('find')
+    async def find(
+        self, specification: 'DDDSpecification', limit: int | None = None
+    ) -> typing.List[T_DDDEntity]:
+        """
+        Find the entities satisfying a specification using a single query
+        Args:
+            specification: The specification the entities must satisfy
+            limit: The maximum number of entities to return
+        Returns:
+            The entities satisfying the specification
+        """
+        query = select(self.model_class).where(specification.compile(self.model_class))
+        if limit is not None:
+            query = query.order_by(self.model_class.uid).limit(limit)
+        try:
+            async with self._read_session_maker()() as session:
+                models = (await session.scalars(query)).all()
+                with hydration_scope():
+                    return [await self._hydrate(m) for m in models]
+        except SQLAlchemyError as sae:
+            raise DDDException(
+                code=500, msg='Failure finding entities in persistence'
+            ) from sae
+
+    @_instrumented('count')
+    async def count(
+        self, specification: typing.Optional['DDDSpecification'] = None
+    ) -> int:
+        """
+        Count the entities satisfying a specification, or all entities if there is none
+        """
+        query = select(func.count()).select_from(self.model_class)
+        if specification is not None:
+            query = query.where(specification.compile(self.model_class))
+        try:
+            async with self._read_session_maker()() as session:
+                return (await session.execute(query)).scalar_one()
+        except SQLAlchemyError as sae:
+            raise DDDException(
+                code=500, msg='Failure counting entities in persistence'
+            ) from sae
+
+    async def watermark(self) -> int:
+        """
+        Return the revision of the last committed write, to be passed to changes_since
+        Raises:
+            DDDException: If the repository does not track revisions
+        """
+        self._require_revisions()
+        try:
+            async with self._read_session_maker()() as session:
+                return (
+                    await session.execute(select(revisions_table.c.value))
+                ).scalar_one_or_none() or 0
+        except SQLAlchemyError as sae:
+            raise DDDException(code=500, msg='Failure reading the watermark') from sae
+
+    async def changes_since(
+        self, watermark: int = 0, chunk_size: int | None = None
+    ) -> typing.AsyncIterator[DDDChange]:
+        """
+        Stream the entities created or modified and the uids removed after a watermark, ordered
+        by revision. Entities modified several times are reported once, with their latest state.
+        The revision of the last change consumed is the watermark for the next call. Rows written
+        before revisions were tracked have no revision, they are only reported for watermark 0,
+        first and with revision 0.
+        Args:
+            watermark: The revision after which changes are reported, 0 for everything
+            chunk_size: The number of rows to fetch per round trip, defaults to chunk_size
+        Yields:
+            The changes
+        Raises:
+            DDDException: If the repository does not track revisions
+        """
+        self._require_revisions()
+        revision = self.model_class.revision
+        after = revision > watermark
+        if watermark == 0:
+            after = or_(after, revision.is_(None))
+        try:
+            async with self._read_session_maker()() as session:
+                tombstones = (
+                    await session.execute(
+                        select(tombstones_table.c.uid, tombstones_table.c.revision)
+                        .where(
+                            tombstones_table.c.aggregate
+                            == self.model_class.__tablename__,
+                            tombstones_table.c.revision > watermark,
+                        )
+                        .order_by(tombstones_table.c.revision, tombstones_table.c.uid)
+                    )
+                ).all()
+                removals = iter(tombstones)
+                removal = next(removals, None)
+                result = await session.stream_scalars(
+                    select(self.model_class)
+                    .where(after)
+                    .order_by(revision.asc().nulls_first(), self.model_class.uid)
+                    .execution_options(yield_per=chunk_size or self.chunk_size)
+                )
+                async for models in result.partitions():
+                    with hydration_scope():
+                        changes = [
+                            DDDChange(
+                                revision=m.revision or 0,
+                                uid=UniqueIdentifier(str(m.uid)),
+                                entity=await self._materialize(m),
+                            )
+                            for m in models
+                        ]
+                    for change in changes:
+                        while (
+                            removal is not None and removal.revision <= change.revision
+                        ):
+                            yield DDDChange(
+                                revision=removal.revision,
+                                uid=UniqueIdentifier(str(removal.uid)),
+                            )
+                            removal = next(removals, None)
+                        yield change
+                while removal is not None:
+                    yield DDDChange(
+                        revision=removal.revision,
+                        uid=UniqueIdentifier(str(removal.uid)),
+                    )
+                    removal = next(removals, None)
+        except SQLAlchemyError as sae:
+            raise DDDException(
+                code=500, msg='Failure streaming changes from persistence'
+            ) from sae
+
+    @_instrumented('create')
     async def create(self, entity: T_DDDEntity) -> T_DDDEntity:
         try:
             if not issubclass(type(entity), DDDAggregateRoot):
                 raise EntityInvariantException(
                     code=400, msg='Only aggregate roots can be created'
                 )
-            if entity.uid in self._identity_map:
+            if entity.persisted:
                 return await self.modify(entity)
-            async with self._session_maker() as session, session.begin():
+            uow = DDDUnitOfWork.current(self._session_maker)
+            if uow is not None:
+                uow.changes(self).created[entity.uid] = entity
+                return entity
+            if self._group_commit is not None:
+                entity = await self._group_commit.submit(self, 'created', entity)
+                # Committed in the task of the group commit, not in the context of the caller
+                self._pin_primary()
+                return entity
+            async with self._write_session_maker()() as session, session.begin():
                 model = await self.to_model(entity)
+                for key, value in (await self._stamp(session)).items():
+                    setattr(model, key, value)
                 session.add(model)
                 entity._uid = UniqueIdentifier(model.uid)
+                entity._snapshot = self._model_values(model)
+                await self._record(session, 'created', {entity.uid: entity._snapshot})
                 self._identity_map[entity.uid] = entity
                 await entity.post_create()
-            return self._identity_map[entity.uid]
+            self._created([entity.uid])
+            await self._written([entity.uid])
+            return entity
+        except SQLAlchemyError as sae:
+            raise DDDException(code=500, msg='Failure persisting the entities') from sae
+
+    @_instrumented('create_many')
+    async def create_many(
+        self, entities: typing.Iterable[T_DDDEntity]
+    ) -> typing.List[T_DDDEntity]:
+        """
+        Create multiple entities in a single transaction. New entities are inserted using a single
+        executemany insert, entities already known to the repository are modified instead. The
+        post_create and post_modify hooks are called once the transaction has committed.
+        Args:
+            entities: The entities to create
+        Returns:
+            The created entities
+        """
+        entities = list(entities)
+        if not all(issubclass(type(e), DDDAggregateRoot) for e in entities):
+            raise EntityInvariantException(
+                code=400, msg='Only aggregate roots can be created'
+            )
+        changes = DDDChangeSet()
+        for entity in entities:
+            if entity.persisted:
+                changes.modified[entity.uid] = entity
+            else:
+                changes.created[entity.uid] = entity
+        uow = DDDUnitOfWork.current(self._session_maker)
+        if uow is not None:
+            uow.changes(self).merge(changes)
+            return entities
+        try:
+            async with self._write_session_maker()() as session, session.begin():
+                await self._flush(session, changes)
         except SQLAlchemyError as sae:
             raise DDDException(code=500, msg='Failure persisting the entities') from sae
+        await self._post_flush(changes)
+        return entities
 
+    @_instrumented('modify')
     async def modify(self, entity: T_DDDEntity) -> T_DDDEntity:
         try:
-            if entity.uid not in self._identity_map:
+            if not entity.persisted:
                 raise EntityInvariantException(
                     code=400, msg='This entity is unknown to the repository'
                 )
-            async with self._session_maker() as session, session.begin():
-                persisted = await session.get(self.model_class, str(entity.uid))
-                model = await self.to_model(entity, persisted)
-                session.add(model)
+            uow = DDDUnitOfWork.current(self._session_maker)
+            if uow is not None:
+                uow.changes(self).modified[entity.uid] = entity
+                return entity
+            if self._group_commit is not None:
+                entity = await self._group_commit.submit(self, 'modified', entity)
+                self._pin_primary()
+                return entity
+            async with self._write_session_maker()() as session, session.begin():
+                snapshot = await self._update(session, entity)
+                entity._snapshot = snapshot
                 await entity.post_modify()
+            # The entity may have been evicted from the identity map in the meantime
+            self._identity_map[entity.uid] = entity
+            await self._written([entity.uid])
             return entity
         except SQLAlchemyError as sae:
             raise DDDException(code=500, msg='Failure persisting the entities') from sae
 
+    @_instrumented('remove')
     async def remove(self, entity: T_DDDEntity) -> None:
         try:
             await entity.pre_remove()
-            async with self._session_maker() as session, session.begin():
+            uow = DDDUnitOfWork.current(self._session_maker)
+            if uow is not None:
+                uow.changes(self).removed[entity.uid] = entity
+                return
+            async with self._write_session_maker()() as session, session.begin():
                 model = await session.get(self.model_class, str(entity.uid))
                 if model is None:
                     raise EntityNotFoundException()
                 await session.delete(model)
+                await self._tombstone(session, [entity.uid])
+                await self._record(session, 'removed', {entity.uid: None})
+            entity._snapshot = None
+            self._identity_map.pop(entity.uid, None)
+            await self._written([entity.uid])
         except SQLAlchemyError as sae:
             raise DDDException(
                 code=500,
                 msg='Failure removing the entities in persistent store',
             ) from sae
 
+    @_instrumented('remove_many')
+    async def remove_many(self, entities: typing.Iterable[T_DDDEntity]) -> None:
+        """
+        Remove multiple entities in a single transaction. The pre_remove hooks are called first,
+        then the entities are deleted using a single DELETE ... WHERE uid IN (...) per chunk.
+        Args:
+            entities: The entities to remove
+        Raises:
+            EntityNotFoundException: If any of the entities does not exist
+        """
+        changes = DDDChangeSet()
+        for entity in entities:
+            await entity.pre_remove()
+            changes.removed[entity.uid] = entity
+        uow = DDDUnitOfWork.current(self._session_maker)
+        if uow is not None:
+            uow.changes(self).merge(changes)
+            return
+        try:
+            async with self._write_session_maker()() as session, session.begin():
+                await self._flush_removes(session, changes)
+        except SQLAlchemyError as sae:
+            raise DDDException(
+                code=500,
+                msg='Failure removing the entities in persistent store',
+            ) from sae
+        await self._post_flush(changes)
+
+    async def _hydrate(self, model: T_DDDModel) -> T_DDDEntity:
+        uid = UniqueIdentifier(str(model.uid))
+        entity = self._identity_map.get(uid)
+        if entity is None:
+            self._hydrated(1)
+            entity = await self._materialize(model)
+            # Another caller may have hydrated the same entity while we were waiting
+            entity = self._identity_map.setdefault(uid, entity)
+        return entity
+
+    async def _streamed(self, model: T_DDDModel) -> T_DDDEntity:
+        if self._identity_map.bounded:
+            return await self._hydrate(model)
+        entity = self._identity_map.get(UniqueIdentifier(str(model.uid)))
+        if entity is None:
+            self._hydrated(1)
+            entity = await self._materialize(model)
+        return entity
+
+    @classmethod
+    async def _materialize(cls, model: T_DDDModel) -> T_DDDEntity:
+        """
+        Build an entity from a persisted model. The entity is clean and remembers the persisted
+        column values, it only becomes dirty once it is changed.
+        """
+        entity = await cls.from_model(model)
+        entity._snapshot = cls._model_values(model)
+        entity._dirty = False
+        return entity
+
+    def _hydrated(self, rows: int) -> None:
+        if self._metrics is not None:
+            self._metrics.hydrated(self.model_class.__tablename__, rows)
+
+    async def _flush(
+        self, session: sqlalchemy.ext.asyncio.AsyncSession, changes: 'DDDChangeSet'
+    ) -> None:
+        if len(changes.created) > 0:
+            stamp = await self._stamp(session)
+            for entity in changes.created.values():
+                changes.snapshots[entity.uid] = {
+                    **self._model_values(await self.to_model(entity)),
+                    **stamp,
+                }
+            await session.execute(
+                insert(self.model_class),
+                [changes.snapshots[uid] for uid in changes.created],
+            )
+            await self._record(
+                session,
+                'created',
+                {uid: changes.snapshots[uid] for uid in changes.created},
+            )
+        for entity in changes.modified.values():
+            changes.snapshots[entity.uid] = await self._update(session, entity)
+
+    async def _update(
+        self, session: sqlalchemy.ext.asyncio.AsyncSession, entity: T_DDDEntity
+    ) -> typing.Dict[str, typing.Any]:
+        """
+        Update only the columns that changed since the entity was last persisted, without reading
+        the row first. All columns are updated if the persisted state is unknown.
+        Returns:
+            The column values of the entity
+        """
+        values = self._model_values(await self.to_model(entity))
+        changed = {
+            key: value
+            for key, value in values.items()
+            if key not in ('uid', 'revision', 'updated_at')
+            and (entity._snapshot is None or entity._snapshot.get(key) != value)
+        }
+        if len(changed) == 0:
+            values.update(
+                {k: (entity._snapshot or {}).get(k) for k in ('revision', 'updated_at')}
+            )
+        else:
+            changed.update(await self._stamp(session))
+            values.update(changed)
+            result = await session.execute(
+                update(self.model_class)
+                .where(self.model_class.uid == str(entity.uid))
+                .values(**changed)
+                .execution_options(synchronize_session=False)
+            )
+            if result.rowcount == 0:
+                raise EntityNotFoundException()
+            await self._record(session, 'modified', {entity.uid: values})
+        return values
+
+    async def _flush_removes(
+        self, session: sqlalchemy.ext.asyncio.AsyncSession, changes: 'DDDChangeSet'
+    ) -> None:
+        uids = [str(uid) for uid in changes.removed]
+        deleted = 0
+        for chunk in self._chunks(uids):
+            result = await session.execute(
+                delete(self.model_class)
+                .where(self.model_class.uid.in_(chunk))
+                .execution_options(synchronize_session=False)
+            )
+            deleted += result.rowcount
+        if deleted < len(uids):
+            raise EntityNotFoundException()
+        await self._tombstone(session, list(changes.removed))
+        await self._record(session, 'removed', {uid: None for uid in changes.removed})
+
+    def _require_revisions(self) -> None:
+        if not self._track_revisions:
+            raise DDDException(
+                code=500,
+                msg=f'{type(self).__name__} does not track revisions',
+            )
+
+    async def _stamp(
+        self, session: sqlalchemy.ext.asyncio.AsyncSession
+    ) -> typing.Dict[str, typing.Any]:
+        """
+        Obtain the columns stamped onto the rows written in the transaction of the session, once
+        per transaction. The revision is only obtained by repositories tracking revisions.
+        """
+        stamp = session.info.setdefault(
+            'ddd_stamp',
+            {'updated_at': datetime.datetime.now(datetime.UTC).replace(tzinfo=None)},
+        )
+        if not self._track_revisions:
+            return {'updated_at': stamp['updated_at']}
+        if 'revision' not in stamp:
+            revision = (
+                await session.execute(
+                    update(revisions_table)
+                    .values(value=revisions_table.c.value + 1)
+                    .returning(revisions_table.c.value)
+                )
+            ).scalar_one_or_none()
+            if revision is None:
+                revision = 1
+                await session.execute(
+                    insert(revisions_table).values(id=0, value=revision)
+                )
+            stamp['revision'] = revision
+        return stamp
+
+    async def _tombstone(
+        self,
+        session: sqlalchemy.ext.asyncio.AsyncSession,
+        uids: typing.List[UniqueIdentifier],
+    ) -> None:
+        if len(uids) == 0 or not self._track_revisions:
+            return
+        stamp = await self._stamp(session)
+        await session.execute(
+            insert(tombstones_table),
+            [
+                {
+                    'aggregate': self.model_class.__tablename__,
+                    'uid': str(uid),
+                    'revision': stamp['revision'],
+                    'removed_at': stamp['updated_at'],
+                }
+                for uid in uids
+            ],
+        )
+
+    async def _record(
+        self,
+        session: sqlalchemy.ext.asyncio.AsyncSession,
+        event: str,
+        changes: typing.Dict[UniqueIdentifier, typing.Dict[str, typing.Any] | None],
+    ) -> None:
+        if self._outbox is None or len(changes) == 0:
+            return
+        await self._outbox.record(
+            session, self.model_class.__tablename__, event, changes
+        )
+
+    async def _post_flush(self, changes: 'DDDChangeSet') -> None:
+        await self._settle(changes)
+        await self._run_hooks(changes)
+
+    async def _settle(self, changes: 'DDDChangeSet') -> None:
+        """
+        Record the committed state of all entities of a change set, before any hook runs, so that
+        a failing hook cannot leave committed entities looking unpersisted
+        """
+        self._created(changes.created)
+        await self._written([*changes.created, *changes.modified, *changes.removed])
+        for entity in [*changes.created.values(), *changes.modified.values()]:
+            entity._snapshot = changes.snapshots.get(entity.uid)
+            self._identity_map[entity.uid] = entity
+        for entity in changes.removed.values():
+            entity._snapshot = None
+            self._identity_map.pop(entity.uid, None)
+
+    async def _run_hooks(self, changes: 'DDDChangeSet') -> None:
+        for entity in changes.created.values():
+            await entity.post_create()
+        for entity in changes.modified.values():
+            await entity.post_modify()
+
+    @classmethod
+    async def resolve(
+        cls, model: T_DDDModel | None, uid: typing.Any = None
+    ) -> T_DDDEntity:
+        """
+        Hydrate a related model while loading another aggregate. The entity is shared with
+        everything else hydrated in the current hydration scope and taken from the identity map
+        of this repository class if one has been instantiated. If the related model was not
+        loaded alongside, because it is stored in another database such as another shard, it is
+        loaded by its uid through the repository of this class.
+        Args:
+            model: The related model, None if it was not loaded alongside
+            uid: The uid of the related model, required if the model was not loaded
+        Returns:
+            The shared entity for the model
+        Raises:
+            DDDException: If the model was not loaded and there is no repository to load it
+        """
+        uid = UniqueIdentifier(str(model.uid if model is not None else uid))
+        key = (cls.model_class, uid)
+        scope = _hydration_scope.get()
+        if scope is not None and key in scope:
+            return scope[key]
+        repository = getattr(cls.entity_class, 'repository', None)
+        if model is None:
+            if not isinstance(repository, cls):
+                raise DDDException(
+                    code=500,
+                    msg=f'{cls.model_class.__name__} {uid} is not stored alongside and '
+                    f'there is no {cls.__name__} to load it',
+                )
+            entity = await repository.get_by_uid(uid)
+        elif isinstance(repository, cls):
+            entity = await repository._hydrate(model)
+        else:
+            entity = await cls._materialize(model)
+        if scope is not None:
+            scope[key] = entity
+        return entity
+
+    @classmethod
+    def _dependency_order(cls) -> int:
+        return cls.model_class.metadata.sorted_tables.index(cls.model_class.__table__)
+
+    @classmethod
+    def _model_values(cls, model: DDDModel) -> typing.Dict[str, typing.Any]:
+        return {
+            attr.key: getattr(model, attr.key) for attr in model.__mapper__.column_attrs
+        }
+
+    @classmethod
+    def _column(cls, key: str) -> sqlalchemy.ColumnElement:
+        if key not in cls.model_class.__table__.columns:
+            raise EntityInvariantException(
+                code=400, msg=f'{cls.model_class.__name__} has no column {key}'
+            )
+        return getattr(cls.model_class, key)
+
+    @staticmethod
+    def _encode_cursor(order_by: str, key: typing.Any, uid: typing.Any) -> str:
+        raw = json.dumps([order_by, str(key), str(uid)]).encode('utf-8')
+        return base64.urlsafe_b64encode(raw).decode('ascii')
+
+    @staticmethod
+    def _decode_cursor(cursor: str, order_by: str) -> typing.Tuple[str, str]:
+        try:
+            cursor_order_by, key, uid = json.loads(base64.urlsafe_b64decode(cursor))
+            uid = str(uuid.UUID(uid))
+            if not isinstance(key, str):
+                raise TypeError(f'Invalid cursor key {key!r}')
+        except (ValueError, TypeError, AttributeError) as e:
+            raise EntityInvariantException(code=400, msg='Invalid cursor') from e
+        if cursor_order_by != order_by:
+            raise EntityInvariantException(
+                code=400, msg='The cursor was issued for a different ordering'
+            )
+        return key, uid
+
+    @classmethod
+    def _chunks(
+        cls, items: typing.Sequence[typing.Any]
+    ) -> typing.Iterator[typing.Sequence[typing.Any]]:
+        for i in range(0, len(items), cls.chunk_size):
+            yield items[i : i + cls.chunk_size]
+
     @classmethod
     @abc.abstractmethod
     async def from_model(cls, model: T_DDDModel, *args, **kwargs) -> T_DDDEntity:
@@ -331,3 +1508,263 @@ class DDDRepository(typing.Generic[T_DDDEntity, T_DDDModel], abc.ABC):
 
     def __repr__(self):
         return f'{self.__class__.__name__}({self.entity_class})'
+
+
+@dataclasses.dataclass
+class DDDChangeSet:
+    """
+    The pending changes to the entities of a single repository
+    """
+
+    created: typing.Dict[UniqueIdentifier, DDDEntity] = dataclasses.field(
+        default_factory=dict
+    )
+    modified: typing.Dict[UniqueIdentifier, DDDEntity] = dataclasses.field(
+        default_factory=dict
+    )
+    removed: typing.Dict[UniqueIdentifier, DDDEntity] = dataclasses.field(
+        default_factory=dict
+    )
+    # The column values written for created and modified entities
+    snapshots: typing.Dict[UniqueIdentifier, typing.Dict[str, typing.Any]] = (
+        dataclasses.field(default_factory=dict)
+    )
+
+    def merge(self, other: 'DDDChangeSet') -> None:
+        self.created.update(other.created)
+        self.modified.update(other.modified)
+        self.removed.update(other.removed)
+        for uid in self.removed:
+            self.created.pop(uid, None)
+            self.modified.pop(uid, None)
+
+
+class DDDUnitOfWork:
+    """
+    A unit of work collecting the changes made through all repositories sharing a session maker
+    and flushing them in a single transaction when the context exits without an exception.
+    Dirty entities in the identity maps of these repositories are flushed as well. Inserts and
+    updates are ordered by the foreign key dependencies of their models, removals in reverse.
+    """
+
+    _current: typing.ClassVar[contextvars.ContextVar['DDDUnitOfWork | None']] = (
+        contextvars.ContextVar('DDDUnitOfWork', default=None)
+    )
+
+    def __init__(
+        self, session_maker: sqlalchemy.ext.asyncio.async_sessionmaker
+    ) -> None:
+        self._session_maker = session_maker
+        self._changes: typing.Dict[DDDRepository, DDDChangeSet] = {}
+        self._token: contextvars.Token | None = None
+
+    @classmethod
+    def current(
+        cls, session_maker: sqlalchemy.ext.asyncio.async_sessionmaker
+    ) -> typing.Optional['DDDUnitOfWork']:
+        """
+        Return the active unit of work if there is one for the provided session maker
+        """
+        uow = cls._current.get()
+        if uow is None or uow.session_maker is not session_maker:
+            return None
+        return uow
+
+    @property
+    def session_maker(self) -> sqlalchemy.ext.asyncio.async_sessionmaker:
+        return self._session_maker
+
+    def changes(self, repository: DDDRepository) -> DDDChangeSet:
+        return self._changes.setdefault(repository, DDDChangeSet())
+
+    async def commit(self) -> None:
+        """
+        Flush all pending changes in a single transaction, then call the entity hooks
+        Raises:
+            DDDException
+        """
+        for repository in list(DDDRepository._instances):
+            if repository._session_maker is not self._session_maker:
+                continue
+            for entity in list(repository._identity_map.values()):
+                if not entity.dirty:
+                    continue
+                changes = self.changes(repository)
+                if entity.uid not in changes.removed:
+                    changes.modified.setdefault(entity.uid, entity)
+        pending = sorted(
+            self._changes.items(), key=lambda item: item[0]._dependency_order()
+        )
+        try:
+            async with self._session_maker() as session, session.begin():
+                for repository, changes in pending:
+                    await repository._flush(session, changes)
+                for repository, changes in reversed(pending):
+                    await repository._flush_removes(session, changes)
+        except SQLAlchemyError as sae:
+            raise DDDException(
+                code=500, msg='Failure committing the unit of work'
+            ) from sae
+        finally:
+            self._changes = {}
+        for repository, changes in pending:
+            await repository._settle(changes)
+        for repository, changes in pending:
+            await repository._run_hooks(changes)
+
+    def rollback(self) -> None:
+        """
+        Discard all pending changes
+        """
+        self._changes = {}
+
+    async def __aenter__(self) -> typing.Self:
+        self._token = self._current.set(self)
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb) -> None:
+        self._current.reset(self._token)
+        self._token = None
+        if exc_type is None:
+            await self.commit()
+        else:
+            self.rollback()
+
+
+class DDDGroupCommit:
+    """
+    Merges the creates and modifies of concurrent callers into a single transaction per session
+    maker. A batch is committed once the window has passed since its first entity or when it
+    reaches max_size entities, whichever comes first. Each caller waits for the commit of its
+    entity. The transactions of different session makers succeed or fail independently, the
+    entities of a transaction that rolled back are retried in a transaction each so that only the
+    callers of the failing entities receive an exception. Errors raised by post hooks after the
+    commit are only reported to the callers of their entity.
+    """
+
+    def __init__(self, window: float = 0.005, max_size: int = 100) -> None:
+        """
+        Args:
+            window: Seconds to wait for more entities after the first entity of a batch
+            max_size: The number of entities after which a batch is committed immediately
+        """
+        self._window = window
+        self._max_size = max_size
+        self._pending: typing.List[
+            typing.Tuple[DDDRepository, str, DDDEntity, asyncio.Future]
+        ] = []
+        self._timer: asyncio.TimerHandle | None = None
+        self._tasks: typing.Set[asyncio.Task] = set()
+
+    async def submit(
+        self, repository: DDDRepository, kind: str, entity: T_DDDEntity
+    ) -> T_DDDEntity:
+        """
+        Add an entity to the current batch and wait for the batch to commit
+        Args:
+            repository: The repository of the entity
+            kind: Either 'created' or 'modified'
+            entity: The entity to persist
+        Returns:
+            The persisted entity
+        Raises:
+            DDDException: If persisting this entity failed
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((repository, kind, entity, future))
+        if len(self._pending) >= self._max_size:
+            self._start()
+        elif self._timer is None:
+            self._timer = loop.call_later(self._window, self._start)
+        return await future
+
+    async def flush(self) -> None:
+        """
+        Commit the current batch without waiting for the window to pass
+        """
+        self._start()
+        if len(self._tasks) > 0:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def _start(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if len(batch) == 0:
+            return
+        task = asyncio.create_task(self._commit(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _commit(
+        self,
+        batch: typing.List[typing.Tuple[DDDRepository, str, DDDEntity, asyncio.Future]],
+    ) -> None:
+        transactions: typing.Dict[
+            sqlalchemy.ext.asyncio.async_sessionmaker,
+            typing.List[typing.Tuple[DDDRepository, str, DDDEntity, asyncio.Future]],
+        ] = {}
+        for entry in batch:
+            transactions.setdefault(entry[0]._session_maker, []).append(entry)
+        for entries in transactions.values():
+            await self._commit_transaction(entries)
+
+    async def _commit_transaction(
+        self,
+        entries: typing.List[
+            typing.Tuple[DDDRepository, str, DDDEntity, asyncio.Future]
+        ],
+    ) -> None:
+        """
+        Commit the entries of a single session maker. If the transaction rolls back, its entries
+        are retried in a transaction each. Once committed, the post hooks of each entity run on
+        their own, so that a failing hook only fails the callers of its entity.
+        """
+        changes: typing.Dict[DDDRepository, DDDChangeSet] = {}
+        for repository, kind, entity, _ in entries:
+            getattr(changes.setdefault(repository, DDDChangeSet()), kind)[
+                entity.uid
+            ] = entity
+        pending = sorted(changes.items(), key=lambda item: item[0]._dependency_order())
+        try:
+            async with entries[0][0]._session_maker() as session, session.begin():
+                for repository, changeset in pending:
+                    await repository._flush(session, changeset)
+        except Exception as e:
+            if len(entries) > 1:
+                for entry in entries:
+                    await self._commit_transaction([entry])
+                return
+            if isinstance(e, SQLAlchemyError):
+                cause, e = (
+                    e,
+                    DDDException(code=500, msg='Failure persisting the entities'),
+                )
+                e.__cause__ = cause
+            # The caller may have been cancelled in the meantime
+            if not entries[0][3].done():
+                entries[0][3].set_exception(e)
+            return
+        outcomes: typing.Dict[
+            typing.Tuple[DDDRepository, UniqueIdentifier], typing.Any
+        ] = {}
+        for repository, changeset in pending:
+            for kind in ('created', 'modified'):
+                for uid, entity in getattr(changeset, kind).items():
+                    single = DDDChangeSet(snapshots={uid: changeset.snapshots.get(uid)})
+                    getattr(single, kind)[uid] = entity
+                    try:
+                        await repository._post_flush(single)
+                        outcomes[(repository, uid)] = None
+                    except Exception as e:
+                        outcomes[(repository, uid)] = e
+        for repository, _, entity, future in entries:
+            if future.done():
+                continue
+            error = outcomes.get((repository, entity.uid))
+            if error is None:
+                future.set_result(entity)
+            else:
+                future.set_exception(error)
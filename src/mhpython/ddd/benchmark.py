@@ -0,0 +1,465 @@
+#  MIT License
+#
+#  Copyright (c) 2024 Mathieu Imfeld
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to deal
+#  in the Software without restriction, including without limitation the rights
+#  to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#  copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in all
+#  copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import argparse
+import asyncio
+import ipaddress
+import json
+import pathlib
+import random
+import statistics
+import sys
+import time
+import typing
+import uuid
+
+import sqlalchemy
+import sqlalchemy.ext.asyncio
+from sqlalchemy import insert
+
+from mhpython import __version__
+from mhpython.ddd.base import DDDModel, UniqueIdentifier
+from mhpython.ddd.domain import NetworkEntity
+from mhpython.ddd.model import ClusterModel, ImageModel, NetworkModel, NodeModel
+from mhpython.ddd.repository import (
+    ClusterRepository,
+    ImageRepository,
+    NetworkRepository,
+    NodeRepository,
+)
+from mhpython.ddd.uid import use_binary_uids, uuid7
+
+#
+# The identifier layouts to compare: name, identifier generator and whether to store binary
+
+UID_LAYOUTS: typing.List[typing.Tuple[str, typing.Callable[[], uuid.UUID], bool]] = [
+    ('uuid4-string', uuid.uuid4, False),
+    ('uuid7-string', uuid7, False),
+    ('uuid7-binary', uuid7, True),
+]
+
+
+async def index_size(engine: sqlalchemy.ext.asyncio.AsyncEngine, table: str) -> int:
+    """
+    Return the size in bytes of the primary key index of a table, using the SQLite dbstat
+    virtual table. Returns -1 if dbstat is not available.
+    """
+    async with engine.connect() as conn:
+        try:
+            result = await conn.execute(
+                sqlalchemy.text(
+                    'SELECT SUM(pgsize) FROM dbstat WHERE name = :name',
+                ),
+                {'name': f'sqlite_autoindex_{table}_1'},
+            )
+            return result.scalar_one() or 0
+        except sqlalchemy.exc.OperationalError:
+            return -1
+
+
+async def bench_uids(
+    workdir: pathlib.Path, rows: int, chunk_size: int
+) -> typing.List[typing.Dict[str, typing.Any]]:
+    results = []
+    table = ClusterModel.__table__
+    for name, generator, binary in UID_LAYOUTS:
+        db = workdir.joinpath(f'uids-{name}.sqlite')
+        db.unlink(missing_ok=True)
+        engine = sqlalchemy.ext.asyncio.create_async_engine(f'sqlite+aiosqlite:///{db}')
+        if binary:
+            use_binary_uids(engine)
+        try:
+            async with engine.begin() as conn:
+                await conn.run_sync(DDDModel.metadata.create_all)
+            start = time.perf_counter()
+            for offset in range(0, rows, chunk_size):
+                count = min(chunk_size, rows - offset)
+                async with engine.begin() as conn:
+                    await conn.execute(
+                        insert(table),
+                        [
+                            {'uid': generator(), 'name': f'Cluster {offset + i}'}
+                            for i in range(0, count)
+                        ],
+                    )
+            elapsed = time.perf_counter() - start
+            results.append(
+                {
+                    'layout': name,
+                    'rows': rows,
+                    'seconds': round(elapsed, 3),
+                    'rows_per_second': round(rows / elapsed),
+                    'index_bytes': await index_size(engine, table.name),
+                    'file_bytes': db.stat().st_size,
+                }
+            )
+        finally:
+            await engine.dispose()
+            db.unlink(missing_ok=True)
+    return results
+
+
+async def seed(
+    engine: sqlalchemy.ext.asyncio.AsyncEngine, scale: int, chunk_size: int
+) -> typing.List[str]:
+    """
+    Seed as many networks, images, clusters and nodes as the scale, using bulk inserts
+    Returns:
+        The uids of the nodes
+    """
+    uids: typing.Dict[str, typing.List[str]] = {}
+    rows: typing.Dict[str, typing.Callable[[int], typing.Dict[str, typing.Any]]] = {
+        'networks': lambda i: {
+            'name': f'Network {i}',
+            'network': str(ipaddress.IPv4Address((i << 8) & 0xFFFFFF00)),
+            'netmask': '255.255.255.0',
+            'router': str(ipaddress.IPv4Address(((i << 8) & 0xFFFFFF00) + 1)),
+            'network_start': (i << 8) & 0xFFFFFF00,
+            'network_end': ((i << 8) & 0xFFFFFF00) + 255,
+        },
+        'images': lambda i: {'name': f'Image {i}', 'url': f'/{i}.img', 'path': f'{i}'},
+        'clusters': lambda i: {'name': f'Cluster {i}'},
+        'nodes': lambda i: {
+            'name': f'Node {i}',
+            'network_uid': uids['networks'][i],
+            'image_uid': uids['images'][i],
+            'cluster_uid': uids['clusters'][i],
+        },
+    }
+    for model in (NetworkModel, ImageModel, ClusterModel, NodeModel):
+        table = model.__table__
+        uids[table.name] = [str(uuid7()) for _ in range(0, scale)]
+        for offset in range(0, scale, chunk_size):
+            async with engine.begin() as conn:
+                await conn.execute(
+                    insert(table),
+                    [
+                        {'uid': uids[table.name][i], **rows[table.name](i)}
+                        for i in range(offset, min(offset + chunk_size, scale))
+                    ],
+                )
+    return uids['nodes']
+
+
+async def timed(
+    scale: int,
+    operation: str,
+    calls: typing.Iterable[typing.Callable[[], typing.Awaitable[typing.Any]]],
+) -> typing.Dict[str, typing.Any]:
+    """
+    Await each call in turn and summarise their latencies
+    """
+    latencies = []
+    start = time.perf_counter()
+    for call in calls:
+        call_start = time.perf_counter()
+        await call()
+        latencies.append(time.perf_counter() - call_start)
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        'scale': scale,
+        'operation': operation,
+        'count': len(latencies),
+        'seconds': round(elapsed, 3),
+        'ops_per_second': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(statistics.median(latencies) * 1000, 3),
+        'p99_ms': round(latencies[int(len(latencies) * 0.99)] * 1000, 3),
+    }
+
+
+async def bench_repositories(
+    workdir: pathlib.Path, scales: typing.List[int], operations: int, chunk_size: int
+) -> typing.List[typing.Dict[str, typing.Any]]:
+    results = []
+    for scale in scales:
+        db = workdir.joinpath(f'repositories-{scale}.sqlite')
+        db.unlink(missing_ok=True)
+        engine = sqlalchemy.ext.asyncio.create_async_engine(f'sqlite+aiosqlite:///{db}')
+        try:
+            async with engine.begin() as conn:
+                await conn.run_sync(DDDModel.metadata.create_all)
+            start = time.perf_counter()
+            node_uids = await seed(engine, scale, chunk_size)
+            elapsed = time.perf_counter() - start
+            results.append(
+                {
+                    'scale': scale,
+                    'operation': 'seed',
+                    'count': scale * 4,
+                    'seconds': round(elapsed, 3),
+                    'ops_per_second': round(scale * 4 / elapsed, 1),
+                }
+            )
+            session_maker = sqlalchemy.ext.asyncio.async_sessionmaker(
+                engine, expire_on_commit=False
+            )
+            ImageRepository(session_maker)
+            ClusterRepository(session_maker)
+            networks = NetworkRepository(session_maker)
+            nodes = NodeRepository(session_maker)
+            sample = [
+                UniqueIdentifier(uid)
+                for uid in random.Random(scale).sample(
+                    node_uids, min(operations, scale)
+                )
+            ]
+
+            entities = [
+                NetworkEntity(
+                    name=f'Benchmark Network {i}',
+                    network='10.0.0.0',
+                    netmask='255.255.255.0',
+                    router='10.0.0.1',
+                )
+                for i in range(0, operations)
+            ]
+            results.append(
+                await timed(
+                    scale,
+                    'create',
+                    [lambda e=e: networks.create(e) for e in entities],
+                )
+            )
+            results.append(
+                await timed(
+                    scale,
+                    'get_by_uid_cold',
+                    [lambda uid=uid: nodes.get_by_uid(uid) for uid in sample],
+                )
+            )
+            results.append(
+                await timed(
+                    scale,
+                    'get_by_uid_warm',
+                    [lambda uid=uid: nodes.get_by_uid(uid) for uid in sample],
+                )
+            )
+            results.append(await timed(scale, 'list', [networks.list]))
+            results.append(
+                await timed(
+                    scale,
+                    'project',
+                    [lambda: networks.project(('uid', 'name', 'network', 'netmask'))],
+                )
+            )
+            results.append(
+                await timed(
+                    scale,
+                    'project_nodes',
+                    [lambda: nodes.project(('uid', 'name', 'network.name'))],
+                )
+            )
+            for entity in entities:
+                entity.name = f'Modified {entity.name}'
+            results.append(
+                await timed(
+                    scale,
+                    'modify',
+                    [lambda e=e: networks.modify(e) for e in entities],
+                )
+            )
+            results.append(
+                await timed(
+                    scale,
+                    'remove',
+                    [lambda e=e: networks.remove(e) for e in entities],
+                )
+            )
+        finally:
+            await engine.dispose()
+            db.unlink(missing_ok=True)
+    return results
+
+
+#
+# The fields identifying a result and the throughput metric compared against a baseline, higher
+# is better
+
+BENCHMARKS: typing.Dict[str, typing.Tuple[typing.Tuple[str, ...], str]] = {
+    'uids': (('layout', 'rows'), 'rows_per_second'),
+    'repositories': (('scale', 'operation'), 'ops_per_second'),
+}
+
+
+def compare(
+    benchmark: str,
+    results: typing.List[typing.Dict[str, typing.Any]],
+    baseline: typing.List[typing.Dict[str, typing.Any]],
+    tolerance: float,
+) -> typing.List[typing.Dict[str, typing.Any]]:
+    """
+    Compare results against a baseline of the same benchmark. Adds the baseline throughput and the
+    relative change to each result that has a baseline.
+    Args:
+        benchmark: The name of the benchmark
+        results: The current results
+        baseline: The stored results to compare with
+        tolerance: The relative drop in throughput tolerated, e.g. 0.1 for 10%
+    Returns:
+        The results whose throughput dropped by more than the tolerance
+    """
+    key, metric = BENCHMARKS[benchmark]
+    previous = {tuple(b.get(k) for k in key): b.get(metric) for b in baseline}
+    regressions = []
+    for result in results:
+        before = previous.get(tuple(result[k] for k in key))
+        if not before:
+            continue
+        change = (result[metric] - before) / before
+        result['baseline'] = before
+        result['change'] = f'{change:+.1%}'
+        if change < -tolerance:
+            regressions.append(result)
+    return regressions
+
+
+def print_results(results: typing.List[typing.Dict[str, typing.Any]]) -> None:
+    if len(results) == 0:
+        return
+    keys = list(dict.fromkeys(k for r in results for k in r))
+    widths = {k: max(len(k), *(len(str(r.get(k, ''))) for r in results)) for k in keys}
+    print('  '.join(k.ljust(widths[k]) for k in keys))
+    for result in results:
+        print('  '.join(str(result.get(k, '')).ljust(widths[k]) for k in keys))
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(f'DDD Benchmark -- {__version__}')
+    parser.add_argument(
+        '--workdir',
+        dest='workdir',
+        type=pathlib.Path,
+        required=False,
+        default=pathlib.Path.cwd().joinpath('build'),
+        help='Directory for the benchmark databases',
+    )
+    parser.add_argument(
+        '--output',
+        dest='output',
+        type=pathlib.Path,
+        required=False,
+        help='Write the results as JSON to this file',
+    )
+    parser.add_argument(
+        '--baseline',
+        dest='baseline',
+        type=pathlib.Path,
+        required=False,
+        help='Compare with the JSON results of a previous run and fail on regressions',
+    )
+    parser.add_argument(
+        '--tolerance',
+        dest='tolerance',
+        type=float,
+        required=False,
+        default=0.1,
+        help='Relative drop in throughput tolerated before flagging a regression',
+    )
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+    uids_parser = subparsers.add_parser(
+        'uids', help='Compare insert throughput and index size of identifier layouts'
+    )
+    uids_parser.add_argument(
+        '--rows',
+        dest='rows',
+        type=int,
+        required=False,
+        default=1_000_000,
+        help='Number of rows to insert per layout',
+    )
+    uids_parser.add_argument(
+        '--chunk-size',
+        dest='chunk_size',
+        type=int,
+        required=False,
+        default=10_000,
+        help='Number of rows to insert per transaction',
+    )
+    repositories_parser = subparsers.add_parser(
+        'repositories',
+        help='Measure repository operations against seeded databases of several scales',
+    )
+    repositories_parser.add_argument(
+        '--scale',
+        dest='scales',
+        type=int,
+        action='append',
+        required=False,
+        help='Number of networks, images, clusters and nodes to seed, may be repeated '
+        '(default 10000, 100000 and 1000000)',
+    )
+    repositories_parser.add_argument(
+        '--operations',
+        dest='operations',
+        type=int,
+        required=False,
+        default=1_000,
+        help='Number of calls timed per operation',
+    )
+    repositories_parser.add_argument(
+        '--chunk-size',
+        dest='chunk_size',
+        type=int,
+        required=False,
+        default=10_000,
+        help='Number of rows to seed per transaction',
+    )
+    args = parser.parse_args()
+
+    args.workdir.mkdir(parents=True, exist_ok=True)
+    try:
+        match args.benchmark:
+            case 'uids':
+                results = asyncio.run(
+                    bench_uids(args.workdir, args.rows, args.chunk_size)
+                )
+            case _:
+                results = asyncio.run(
+                    bench_repositories(
+                        args.workdir,
+                        args.scales or [10_000, 100_000, 1_000_000],
+                        args.operations,
+                        args.chunk_size,
+                    )
+                )
+    except KeyboardInterrupt:
+        return 0
+    regressions = []
+    if args.baseline is not None:
+        regressions = compare(
+            args.benchmark,
+            results,
+            json.loads(args.baseline.read_text()),
+            args.tolerance,
+        )
+    print_results(results)
+    if args.output is not None:
+        args.output.write_text(json.dumps(results, indent=2))
+    if len(regressions) > 0:
+        print(f'{len(regressions)} regressions beyond {args.tolerance:.0%}:')
+        print_results(regressions)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
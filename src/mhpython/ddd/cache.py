@@ -0,0 +1,388 @@
+#  MIT License
+#
+#  Copyright (c) 2024 Mathieu Imfeld
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to deal
+#  in the Software without restriction, including without limitation the rights
+#  to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#  copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in all
+#  copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import abc
+import collections
+import hashlib
+import math
+import pathlib
+import pickle
+import sqlite3
+import threading
+import time
+import typing
+import uuid
+
+from mhpython.ddd.identity_map import DDDIdentityMapStats
+
+#
+# Cached values are the column values of a single row
+
+CacheValues = typing.Dict[str, typing.Any]
+
+
+class DDDCache(abc.ABC):
+    """
+    Base class for second-level caches of persisted column values, shared by any number of
+    repositories. Every key carries a version that is bumped whenever the key is invalidated.
+    A value loaded from persistence may only be stored under the version obtained before it was
+    loaded, so a load that raced with a write can never put a stale value into the cache.
+    """
+
+    # Whether the methods block on I/O, in which case repositories call them in a worker thread
+    # instead of on the event loop
+    blocking: typing.ClassVar[bool] = False
+
+    def __init__(self, ttl: float = 300.0) -> None:
+        self._ttl = ttl
+        self._stats = DDDIdentityMapStats()
+
+    @property
+    def ttl(self) -> float:
+        return self._ttl
+
+    @property
+    def stats(self) -> DDDIdentityMapStats:
+        return self._stats
+
+    def get(self, key: str) -> CacheValues | None:
+        """
+        Get the values cached for a key, counting the hit or miss
+        Args:
+            key: The cache key
+        Returns:
+            The cached values or None if nothing current is cached
+        """
+        values = self._get(key)
+        if values is None:
+            self._stats.misses += 1
+        else:
+            self._stats.hits += 1
+        return values
+
+    @abc.abstractmethod
+    def _get(self, key: str) -> CacheValues | None:
+        pass
+
+    @abc.abstractmethod
+    def version(self, key: str) -> int:
+        """
+        Return the current version of a key. Must be obtained before loading the values to put.
+        """
+        pass
+
+    @abc.abstractmethod
+    def put(self, key: str, version: int, values: CacheValues) -> bool:
+        """
+        Cache values under a key unless the key has been invalidated since version was obtained
+        Returns:
+            True if the values were cached
+        """
+        pass
+
+    @abc.abstractmethod
+    def invalidate(self, key: str) -> None:
+        """
+        Drop the values cached for a key and bump its version
+        """
+        pass
+
+    def invalidate_many(self, keys: typing.Iterable[str]) -> None:
+        """
+        Drop the values cached for some keys and bump their versions
+        """
+        for key in keys:
+            self.invalidate(key)
+
+
+class DDDLRUCache(DDDCache):
+    """
+    An in-process second-level cache holding at most max_size keys
+    """
+
+    def __init__(self, max_size: int = 100000, ttl: float = 300.0) -> None:
+        super().__init__(ttl)
+        self._max_size = max_size
+        self._lock = threading.Lock()
+        # Global clock of invalidations. Keys that are not (or no longer) tracked are at the
+        # current clock, so any invalidation during a load conservatively rejects its put
+        self._clock = 0
+        self._entries: collections.OrderedDict[
+            str, typing.Tuple[int, float, CacheValues | None]
+        ] = collections.OrderedDict()
+
+    def _get(self, key: str) -> CacheValues | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            _, expires, values = entry
+            if values is None or expires < time.monotonic():
+                return None
+            self._entries.move_to_end(key)
+            return values
+
+    def version(self, key: str) -> int:
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry[0] if entry is not None else self._clock
+
+    def put(self, key: str, version: int, values: CacheValues) -> bool:
+        with self._lock:
+            entry = self._entries.get(key)
+            current = entry[0] if entry is not None else self._clock
+            if version != current:
+                return False
+            self._entries[key] = (version, time.monotonic() + self._ttl, values)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+                self._stats.evictions += 1
+            return True
+
+    def invalidate(self, key: str) -> None:
+        with self._lock:
+            self._clock += 1
+            self._entries[key] = (self._clock, 0.0, None)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+
+
+class DDDSQLiteCache(DDDCache):
+    """
+    A second-level cache in a local SQLite file, shared by all processes on the host that open
+    the same file. Values are pickled, so the file must only be shared by trusted processes.
+    Every call does file I/O and may wait for the write lock of another process, so
+    repositories make the calls in a worker thread.
+    """
+
+    blocking = True
+
+    def __init__(self, path: pathlib.Path, ttl: float = 300.0) -> None:
+        super().__init__(ttl)
+        self._path = path
+        self._conn = sqlite3.connect(
+            path, isolation_level=None, check_same_thread=False
+        )
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS entries ('
+                'key TEXT PRIMARY KEY, version INTEGER NOT NULL, '
+                'expires REAL NOT NULL, value BLOB)'
+            )
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS clock (id INTEGER PRIMARY KEY, value INTEGER)'
+            )
+            self._conn.execute('INSERT OR IGNORE INTO clock (id, value) VALUES (0, 0)')
+
+    @property
+    def path(self) -> pathlib.Path:
+        return self._path
+
+    def _version(self, key: str) -> int:
+        row = self._conn.execute(
+            'SELECT version FROM entries WHERE key = ?', (key,)
+        ).fetchone()
+        if row is None:
+            row = self._conn.execute('SELECT value FROM clock WHERE id = 0').fetchone()
+        return row[0]
+
+    def _get(self, key: str) -> CacheValues | None:
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT value FROM entries WHERE key = ? AND expires >= ? '
+                'AND value IS NOT NULL',
+                (key, time.time()),
+            ).fetchone()
+        return pickle.loads(row[0]) if row is not None else None
+
+    def version(self, key: str) -> int:
+        with self._lock:
+            return self._version(key)
+
+    def put(self, key: str, version: int, values: CacheValues) -> bool:
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                if self._version(key) != version:
+                    return False
+                self._conn.execute(
+                    'INSERT OR REPLACE INTO entries (key, version, expires, value) '
+                    'VALUES (?, ?, ?, ?)',
+                    (key, version, time.time() + self._ttl, pickle.dumps(values)),
+                )
+                return True
+            finally:
+                self._conn.execute('COMMIT')
+
+    def invalidate(self, key: str) -> None:
+        self.invalidate_many([key])
+
+    def invalidate_many(self, keys: typing.Iterable[str]) -> None:
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                for key in keys:
+                    (clock,) = self._conn.execute(
+                        'UPDATE clock SET value = value + 1 WHERE id = 0 RETURNING value'
+                    ).fetchone()
+                    self._conn.execute(
+                        'INSERT OR REPLACE INTO entries (key, version, expires, value) '
+                        'VALUES (?, ?, 0, NULL)',
+                        (key, clock),
+                    )
+            finally:
+                self._conn.execute('COMMIT')
+
+    def purge(self) -> int:
+        """
+        Remove expired values, keeping the versions of invalidated keys
+        Returns:
+            The number of values removed
+        """
+        with self._lock:
+            cursor = self._conn.execute(
+                'DELETE FROM entries WHERE expires < ? AND value IS NOT NULL',
+                (time.time(),),
+            )
+            self._stats.evictions += cursor.rowcount
+            return cursor.rowcount
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+class DDDNegativeCache:
+    """
+    Remembers uids recently found not to exist, so that repeated lookups of deleted or never
+    existing entities do not reach persistence. Like DDDCache, a miss may only be remembered
+    under the generation obtained before it was looked up, so a lookup racing with a create
+    cannot hide the created entity.
+    """
+
+    def __init__(self, max_size: int = 10000, ttl: float = 30.0) -> None:
+        """
+        Args:
+            max_size: The maximum number of uids remembered, the least recently added are dropped
+            ttl: Seconds a uid is remembered, bounding how long creates by others go unnoticed
+        """
+        self._max_size = max_size
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._entries: collections.OrderedDict[uuid.UUID, float] = (
+            collections.OrderedDict()
+        )
+
+    @property
+    def generation(self) -> int:
+        return self._generation
+
+    def __contains__(self, uid: uuid.UUID) -> bool:
+        with self._lock:
+            expires = self._entries.get(uid)
+            if expires is None:
+                return False
+            if expires < time.monotonic():
+                del self._entries[uid]
+                return False
+            return True
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def add(self, uid: uuid.UUID, generation: int) -> bool:
+        """
+        Remember that a uid does not exist unless a uid was discarded since generation
+        Returns:
+            True if the uid is remembered
+        """
+        with self._lock:
+            if generation != self._generation:
+                return False
+            self._entries[uid] = time.monotonic() + self._ttl
+            self._entries.move_to_end(uid)
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+            return True
+
+    def discard(self, uid: uuid.UUID) -> None:
+        with self._lock:
+            self._generation += 1
+            self._entries.pop(uid, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+
+class DDDBloomFilter:
+    """
+    A compact probabilistic set of uids. A uid that is not in the filter certainly was not
+    added, a uid that is in the filter was added with a probability of 1 - error_rate as long
+    as no more than capacity uids were added.
+    """
+
+    def __init__(self, capacity: int, error_rate: float = 0.01) -> None:
+        """
+        Args:
+            capacity: The number of uids the filter is sized for
+            error_rate: The false positive rate at capacity
+        """
+        capacity = max(capacity, 1)
+        self._size = max(
+            8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        )
+        self._hashes = max(1, round(self._size / capacity * math.log(2)))
+        self._bits = bytearray(math.ceil(self._size / 8))
+        self._count = 0
+
+    @property
+    def size_bytes(self) -> int:
+        return len(self._bits)
+
+    def __len__(self) -> int:
+        return self._count
+
+    def _positions(self, uid: uuid.UUID) -> typing.Iterator[int]:
+        # Double hashing, see Kirsch and Mitzenmacher, Less Hashing, Same Performance
+        digest = hashlib.blake2b(uuid.UUID(str(uid)).bytes, digest_size=16).digest()
+        h1 = int.from_bytes(digest[0:8], 'big')
+        h2 = int.from_bytes(digest[8:16], 'big') | 1
+        for i in range(0, self._hashes):
+            yield (h1 + i * h2) % self._size
+
+    def add(self, uid: uuid.UUID) -> None:
+        for position in self._positions(uid):
+            self._bits[position >> 3] |= 1 << (position & 7)
+        self._count += 1
+
+    def __contains__(self, uid: uuid.UUID) -> bool:
+        return all(
+            self._bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(uid)
+        )
@@ -22,7 +22,11 @@
 import pathlib
 import typing
 
-from mhpython.ddd.base import EntityInvariantException, DDDAggregateRoot
+from mhpython.ddd.base import (
+    EntityInvariantException,
+    DDDAggregateRoot,
+    UniqueIdentifier,
+)
 from mhpython.ddd.model import ClusterModel, NodeModel, NetworkModel, ImageModel
 
 
@@ -84,15 +88,99 @@ class NetworkEntity(DDDAggregateRoot[NetworkModel]):
         )
 
 
+class NodeCollection:
+    """
+    The nodes of a cluster, keyed by their unique identifier. A collection with a loader is
+    lazy: membership, add and remove work without loading by falling back to the cluster of the
+    node, iterating requires the members to be loaded first via load() or async iteration.
+    """
+
+    def __init__(
+        self,
+        cluster: 'ClusterEntity',
+        loader: typing.Callable[[], typing.Awaitable[typing.Iterable['NodeEntity']]]
+        | None = None,
+    ) -> None:
+        self._cluster = cluster
+        self._loader = loader
+        self._nodes: typing.Dict[UniqueIdentifier, NodeEntity] = {}
+        self._removed: typing.Set[UniqueIdentifier] = set()
+
+    @property
+    def loaded(self) -> bool:
+        return self._loader is None
+
+    async def load(self) -> typing.Self:
+        if self._loader is not None:
+            for node in await self._loader():
+                if node.uid not in self._removed:
+                    self._nodes.setdefault(node.uid, node)
+            self._loader = None
+            self._removed.clear()
+        return self
+
+    def known(self) -> typing.List['NodeEntity']:
+        """
+        The members currently held in memory, without loading
+        """
+        return list(self._nodes.values())
+
+    def add(self, node: 'NodeEntity') -> None:
+        self._nodes[node.uid] = node
+        self._removed.discard(node.uid)
+
+    def remove(self, node: 'NodeEntity') -> None:
+        self._nodes.pop(node.uid, None)
+        if not self.loaded:
+            self._removed.add(node.uid)
+
+    def __contains__(self, node: typing.Any) -> bool:
+        if node.uid in self._nodes:
+            return True
+        if self.loaded or node.uid in self._removed:
+            return False
+        return node.cluster is not None and node.cluster.uid == self._cluster.uid
+
+    def _require_loaded(self) -> None:
+        if not self.loaded:
+            raise EntityInvariantException(
+                code=400, msg='The nodes of this cluster have not been loaded'
+            )
+
+    def __iter__(self) -> typing.Iterator['NodeEntity']:
+        self._require_loaded()
+        return iter(list(self._nodes.values()))
+
+    async def __aiter__(self) -> typing.AsyncIterator['NodeEntity']:
+        await self.load()
+        for node in list(self._nodes.values()):
+            yield node
+
+    def __len__(self) -> int:
+        self._require_loaded()
+        return len(self._nodes)
+
+    def __eq__(self, other: typing.Any) -> bool:
+        return (
+            isinstance(other, NodeCollection)
+            and self._nodes.keys() == other._nodes.keys()
+        )
+
+    def __repr__(self) -> str:
+        return (
+            f'{self.__class__.__name__}(loaded={self.loaded}, known={len(self._nodes)})'
+        )
+
+
 class ClusterEntity(DDDAggregateRoot[ClusterModel]):
     model = ClusterModel
 
     def __init__(self, name: str) -> None:
         super().__init__(name)
-        self._nodes: typing.List[NodeEntity] = []
+        self._nodes = NodeCollection(self)
 
     @property
-    def nodes(self) -> typing.List['NodeEntity']:
+    def nodes(self) -> NodeCollection:
         return self._nodes
 
     def add_node(self, node: 'NodeEntity') -> None:
@@ -102,17 +190,21 @@ class ClusterEntity(DDDAggregateRoot[ClusterModel]):
             )
         if node in self._nodes:
             return
-        if node.cluster is not None and node.cluster != self:
+        if node.cluster is not None and node.cluster.uid != self.uid:
             # TODO: We may remove the node from the other cluster here instead of raising
             raise EntityInvariantException(
                 code=400, msg='Node is a member of another cluster'
             )
+        self._nodes.add(node)
         node.cluster = self
-        self._nodes.append(node)
         self._dirty = True
 
     def remove_node(self, node: 'NodeEntity') -> None:
-        if node not in self._nodes or node.cluster != self:
+        if (
+            node not in self._nodes
+            or node.cluster is None
+            or node.cluster.uid != self.uid
+        ):
             raise EntityInvariantException(
                 code=400, msg='Node is not a member of this cluster'
             )
@@ -120,12 +212,12 @@ class ClusterEntity(DDDAggregateRoot[ClusterModel]):
         self._dirty = True
 
     async def post_create(self) -> None:
-        for node in self._nodes:
+        for node in self._nodes.known():
             await node.post_create()
         return await super().post_create()
 
     async def post_modify(self) -> None:
-        for node in self._nodes:
+        for node in self._nodes.known():
             await node.post_modify()
         return await super().post_modify()
 
@@ -0,0 +1,179 @@
+#  MIT License
+#
+#  Copyright (c) 2024 Mathieu Imfeld
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to deal
+#  in the Software without restriction, including without limitation the rights
+#  to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#  copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in all
+#  copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import collections
+import collections.abc
+import dataclasses
+import typing
+import uuid
+import weakref
+
+K = typing.TypeVar('K', bound=uuid.UUID)
+V = typing.TypeVar('V')
+
+
+@dataclasses.dataclass
+class DDDIdentityMapStats:
+    """
+    Counters of an identity map. Evictions only count entries dropped by the map itself, not
+    entries that were explicitly removed.
+    """
+
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+
+    @property
+    def hit_ratio(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups > 0 else 0.0
+
+
+class DDDIdentityMap(collections.abc.MutableMapping[K, V]):
+    """
+    An unbounded identity map. Subclasses override the storage to bound its size.
+    """
+
+    # Whether the memory held by the map is bounded, either by its size or by the entities
+    # referenced elsewhere
+    bounded: typing.ClassVar[bool] = False
+
+    def __init__(self) -> None:
+        self._entries: typing.Dict[K, V] = {}
+        self._stats = DDDIdentityMapStats()
+
+    @property
+    def stats(self) -> DDDIdentityMapStats:
+        return self._stats
+
+    def lookup(self, key: K) -> V | None:
+        """
+        Look up an entry, counting the hit or miss
+        Args:
+            key: The unique identifier of the entity
+        Returns:
+            The entity or None if it is not in the identity map
+        """
+        value = self.get(key)
+        if value is None:
+            self._stats.misses += 1
+        else:
+            self._stats.hits += 1
+        return value
+
+    def __getitem__(self, key: K) -> V:
+        return self._entries[key]
+
+    def __setitem__(self, key: K, value: V) -> None:
+        self._entries[key] = value
+
+    def __delitem__(self, key: K) -> None:
+        del self._entries[key]
+
+    def __contains__(self, key: object) -> bool:
+        return key in self._entries
+
+    def __iter__(self) -> typing.Iterator[K]:
+        return iter(list(self._entries))
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def __repr__(self) -> str:
+        return f'{self.__class__.__name__}(size={len(self)}, stats={self._stats})'
+
+
+class DDDLRUIdentityMap(DDDIdentityMap[K, V]):
+    """
+    An identity map holding at most max_size entries, evicting the least recently used one.
+    Dirty entities are never evicted, so that a unit of work still flushes them, the map may
+    hence temporarily exceed max_size while more than max_size entities are dirty.
+    """
+
+    bounded = True
+
+    def __init__(self, max_size: int = 10000) -> None:
+        super().__init__()
+        if max_size < 1:
+            raise ValueError('The identity map must hold at least one entry')
+        self._max_size = max_size
+        self._entries: collections.OrderedDict[K, V] = collections.OrderedDict()
+
+    @property
+    def max_size(self) -> int:
+        return self._max_size
+
+    def __getitem__(self, key: K) -> V:
+        value = self._entries[key]
+        self._entries.move_to_end(key)
+        return value
+
+    def __setitem__(self, key: K, value: V) -> None:
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        if len(self._entries) <= self._max_size:
+            return
+        for candidate in list(self._entries):
+            if len(self._entries) <= self._max_size:
+                break
+            if candidate == key or getattr(self._entries[candidate], 'dirty', False):
+                continue
+            del self._entries[candidate]
+            self._stats.evictions += 1
+
+
+class DDDWeakIdentityMap(DDDIdentityMap[K, V]):
+    """
+    An identity map that only holds weak references, entities are evicted as soon as nothing
+    else refers to them
+    """
+
+    bounded = True
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._entries: typing.Dict[K, weakref.ref] = {}
+
+    def _evict(self, key: K, ref: weakref.ref) -> None:
+        if self._entries.get(key) is ref:
+            del self._entries[key]
+            self._stats.evictions += 1
+
+    def __getitem__(self, key: K) -> V:
+        value = self._entries[key]()
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key: K, value: V) -> None:
+        self._entries[key] = weakref.ref(value, lambda ref: self._evict(key, ref))
+
+    def __contains__(self, key: object) -> bool:
+        ref = self._entries.get(key)
+        return ref is not None and ref() is not None
+
+    def __iter__(self) -> typing.Iterator[K]:
+        return iter(
+            [key for key, ref in list(self._entries.items()) if ref() is not None]
+        )
@@ -0,0 +1,455 @@
+#  MIT License
+#
+#  Copyright (c) 2024 Mathieu Imfeld
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to deal
+#  in the Software without restriction, including without limitation the rights
+#  to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#  copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in all
+#  copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import bisect
+import collections
+import contextlib
+import contextvars
+import dataclasses
+import re
+import time
+import typing
+import weakref
+
+import sqlalchemy.event
+import sqlalchemy.ext.asyncio
+
+if typing.TYPE_CHECKING:
+    from mhpython.ddd.base import DDDRepository
+
+# Latency buckets in seconds
+LATENCY_BUCKETS: typing.Tuple[float, ...] = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+)
+# Buckets for the number of SQL statements issued per call
+QUERY_BUCKETS: typing.Tuple[float, ...] = (0, 1, 2, 4, 8, 16, 32, 64, 128)
+
+#
+# The statement counters of the operations currently measured in this context. Operations may
+# nest, every statement counts towards all of them
+
+_operations: contextvars.ContextVar[typing.Tuple[typing.List[int], ...]] = (
+    contextvars.ContextVar('ddd_operations', default=())
+)
+# The engines whose statements are counted, shared by all DDDMetrics instances
+_engines: weakref.WeakSet[sqlalchemy.Engine] = weakref.WeakSet()
+
+
+def _count(conn, cursor, statement, parameters, context, executemany) -> None:
+    for counter in _operations.get():
+        counter[0] += 1
+
+
+def _sync_engine(
+    session_maker: sqlalchemy.ext.asyncio.async_sessionmaker,
+) -> sqlalchemy.Engine | None:
+    engine = session_maker.kw.get('bind')
+    if isinstance(engine, sqlalchemy.ext.asyncio.AsyncEngine):
+        engine = engine.sync_engine
+    return engine
+
+
+@dataclasses.dataclass
+class DDDHistogram:
+    """
+    A histogram with fixed upper bounds. Counts are per bucket, not cumulative.
+    """
+
+    bounds: typing.Tuple[float, ...]
+    counts: typing.List[int] = dataclasses.field(default_factory=list)
+    sum: float = 0.0
+    count: int = 0
+
+    def __post_init__(self) -> None:
+        if len(self.counts) == 0:
+            # The last bucket is +Inf
+            self.counts = [0] * (len(self.bounds) + 1)
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self) -> typing.List[typing.Tuple[float, int]]:
+        """
+        Return the cumulative counts per upper bound, as in the text exposition format
+        """
+        total = 0
+        result = []
+        for bound, count in zip((*self.bounds, float('inf')), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def copy(self) -> 'DDDHistogram':
+        return DDDHistogram(self.bounds, list(self.counts), self.sum, self.count)
+
+
+@dataclasses.dataclass(frozen=True)
+class DDDOperationSnapshot:
+    """
+    The metrics of an operation of the repositories of an aggregate
+    """
+
+    aggregate: str
+    operation: str
+    latency: DDDHistogram
+    queries: DDDHistogram
+    errors: int
+
+
+@dataclasses.dataclass(frozen=True)
+class DDDAggregateSnapshot:
+    """
+    The metrics of the repositories of an aggregate that are not specific to an operation
+    """
+
+    aggregate: str
+    rows_hydrated: int
+    identity_map_hits: int
+    identity_map_misses: int
+    identity_map_evictions: int
+
+    @property
+    def identity_map_hit_ratio(self) -> float:
+        lookups = self.identity_map_hits + self.identity_map_misses
+        return self.identity_map_hits / lookups if lookups > 0 else 0.0
+
+
+@dataclasses.dataclass(frozen=True)
+class DDDMetricsSnapshot:
+    """
+    A point-in-time copy of all metrics
+    """
+
+    operations: typing.List[DDDOperationSnapshot]
+    aggregates: typing.List[DDDAggregateSnapshot]
+
+    def operation(self, aggregate: str, operation: str) -> DDDOperationSnapshot | None:
+        return next(
+            (
+                o
+                for o in self.operations
+                if o.aggregate == aggregate and o.operation == operation
+            ),
+            None,
+        )
+
+    def aggregate(self, aggregate: str) -> DDDAggregateSnapshot | None:
+        return next((a for a in self.aggregates if a.aggregate == aggregate), None)
+
+
+class DDDMetricsExporter(typing.Protocol):
+    """
+    Exports a snapshot of the metrics
+    """
+
+    def export(self, snapshot: DDDMetricsSnapshot) -> typing.Any: ...
+
+
+class DDDMetrics:
+    """
+    Collects the latency and number of SQL statements of repository operations, the number of rows
+    hydrated into entities and the hit ratio of the identity maps. A single instance may be shared
+    by any number of repositories, metrics are labelled with the table name of their aggregate.
+    """
+
+    def __init__(
+        self,
+        latency_buckets: typing.Tuple[float, ...] = LATENCY_BUCKETS,
+        query_buckets: typing.Tuple[float, ...] = QUERY_BUCKETS,
+    ) -> None:
+        self._latency_buckets = latency_buckets
+        self._query_buckets = query_buckets
+        self._latency: typing.Dict[typing.Tuple[str, str], DDDHistogram] = {}
+        self._queries: typing.Dict[typing.Tuple[str, str], DDDHistogram] = {}
+        self._errors: typing.Dict[typing.Tuple[str, str], int] = (
+            collections.defaultdict(int)
+        )
+        self._hydrated: typing.Dict[str, int] = collections.defaultdict(int)
+        self._repositories: weakref.WeakSet['DDDRepository'] = weakref.WeakSet()
+
+    def register(self, repository: 'DDDRepository') -> None:
+        """
+        Start counting the statements issued through the engines of a repository and report the
+        statistics of its identity map
+        Args:
+            repository: The repository to instrument
+        """
+        self._repositories.add(repository)
+        for session_maker in repository.session_makers:
+            engine = _sync_engine(session_maker)
+            if engine is None or engine in _engines:
+                continue
+            sqlalchemy.event.listen(engine, 'before_cursor_execute', _count)
+            _engines.add(engine)
+
+    @contextlib.contextmanager
+    def measure(self, aggregate: str, operation: str) -> typing.Iterator[None]:
+        """
+        Measure the latency and the number of SQL statements of an operation
+        Args:
+            aggregate: The table name of the aggregate
+            operation: The name of the operation
+        """
+        key = (aggregate, operation)
+        counter = [0]
+        token = _operations.set((*_operations.get(), counter))
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self._errors[key] += 1
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            _operations.reset(token)
+            self._latency.setdefault(key, DDDHistogram(self._latency_buckets)).observe(
+                elapsed
+            )
+            self._queries.setdefault(key, DDDHistogram(self._query_buckets)).observe(
+                counter[0]
+            )
+
+    def hydrated(self, aggregate: str, rows: int) -> None:
+        self._hydrated[aggregate] += rows
+
+    def snapshot(self) -> DDDMetricsSnapshot:
+        """
+        Return a copy of the current metrics
+        """
+        operations = [
+            DDDOperationSnapshot(
+                aggregate=aggregate,
+                operation=operation,
+                latency=latency.copy(),
+                queries=self._queries[(aggregate, operation)].copy(),
+                errors=self._errors.get((aggregate, operation), 0),
+            )
+            for (aggregate, operation), latency in sorted(self._latency.items())
+        ]
+        stats: typing.Dict[str, typing.List[int]] = {}
+        for repository in list(self._repositories):
+            aggregate = repository.model_class.__tablename__
+            counters = stats.setdefault(aggregate, [0, 0, 0])
+            counters[0] += repository.identity_map.stats.hits
+            counters[1] += repository.identity_map.stats.misses
+            counters[2] += repository.identity_map.stats.evictions
+        aggregates = [
+            DDDAggregateSnapshot(
+                aggregate=aggregate,
+                rows_hydrated=self._hydrated.get(aggregate, 0),
+                identity_map_hits=stats.get(aggregate, [0, 0, 0])[0],
+                identity_map_misses=stats.get(aggregate, [0, 0, 0])[1],
+                identity_map_evictions=stats.get(aggregate, [0, 0, 0])[2],
+            )
+            for aggregate in sorted({*stats, *self._hydrated})
+        ]
+        return DDDMetricsSnapshot(operations=operations, aggregates=aggregates)
+
+    def export(self, exporter: DDDMetricsExporter) -> typing.Any:
+        """
+        Export a snapshot of the current metrics
+        Args:
+            exporter: The exporter to use
+        Returns:
+            Whatever the exporter returns
+        """
+        return exporter.export(self.snapshot())
+
+    def reset(self) -> None:
+        """
+        Discard all operation and hydration metrics. Identity map statistics are owned by the
+        identity maps and not reset.
+        """
+        self._latency.clear()
+        self._queries.clear()
+        self._errors.clear()
+        self._hydrated.clear()
+
+
+class DDDQueryBudgetExceeded(AssertionError):
+    """
+    Raised when more statements were issued than the budget allows
+    """
+
+
+class DDDQueryRecorder:
+    """
+    Records every statement executed through the engine of a session maker while active, to
+    assert query budgets in tests and to spot N+1 patterns: statements of the same shape
+    executed over and over, typically once per row loaded by a previous statement.
+
+    with DDDQueryRecorder(session_maker, budget=4):
+        await repository.list()
+    """
+
+    def __init__(
+        self,
+        session_maker: sqlalchemy.ext.asyncio.async_sessionmaker,
+        budget: int | None = None,
+    ) -> None:
+        """
+        Args:
+            session_maker: The session maker whose statements are recorded
+            budget: The maximum number of statements allowed, checked when the context exits
+        """
+        self._engine = _sync_engine(session_maker)
+        self._budget = budget
+        self._statements: typing.List[str] = []
+
+    @property
+    def statements(self) -> typing.List[str]:
+        return list(self._statements)
+
+    @property
+    def count(self) -> int:
+        return len(self._statements)
+
+    @staticmethod
+    def shape(statement: str) -> str:
+        """
+        Normalise a statement so that statements differing only in their parameters are equal
+        """
+        statement = ' '.join(statement.split())
+        statement = re.sub(r"'(?:[^']|'')*'", '?', statement)
+        statement = re.sub(r'\b\d+\b', '?', statement)
+        return re.sub(
+            r'\((?:\s*(?:\?|%\(\w+\)s|\$\d+|__\[POSTCOMPILE_\w+\])\s*,?)+\)',
+            '(...)',
+            statement,
+        )
+
+    def shapes(self) -> typing.Counter[str]:
+        """
+        Return the number of statements per shape
+        """
+        return collections.Counter(self.shape(s) for s in self._statements)
+
+    def repeated(self, threshold: int = 2) -> typing.Dict[str, int]:
+        """
+        Return the shapes executed at least threshold times, the usual sign of an N+1 pattern
+        """
+        return {
+            shape: count
+            for shape, count in self.shapes().most_common()
+            if count >= threshold
+        }
+
+    def assert_budget(self, budget: int) -> None:
+        """
+        Raises:
+            DDDQueryBudgetExceeded: If more than budget statements were recorded
+        """
+        if self.count <= budget:
+            return
+        report = '\n'.join(
+            f'  {count} x {shape}' for shape, count in self.shapes().most_common()
+        )
+        raise DDDQueryBudgetExceeded(
+            f'{self.count} statements exceed the budget of {budget}:\n{report}'
+        )
+
+    def reset(self) -> None:
+        self._statements.clear()
+
+    def _record(self, conn, cursor, statement, parameters, context, executemany):
+        self._statements.append(statement)
+
+    def __enter__(self) -> typing.Self:
+        sqlalchemy.event.listen(self._engine, 'before_cursor_execute', self._record)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        sqlalchemy.event.remove(self._engine, 'before_cursor_execute', self._record)
+        if exc_type is None and self._budget is not None:
+            self.assert_budget(self._budget)
+
+
+class DDDTextExporter:
+    """
+    Renders metrics in the Prometheus text exposition format
+    """
+
+    def __init__(self, prefix: str = 'ddd') -> None:
+        self._prefix = prefix
+
+    def export(self, snapshot: DDDMetricsSnapshot) -> str:
+        lines: typing.List[str] = []
+        for name, attribute, unit in (
+            ('operation_duration_seconds', 'latency', 'seconds'),
+            ('operation_queries', 'queries', 'statements'),
+        ):
+            metric = f'{self._prefix}_{name}'
+            lines.append(f'# HELP {metric} Repository operation {unit}')
+            lines.append(f'# TYPE {metric} histogram')
+            for operation in snapshot.operations:
+                labels = (
+                    f'aggregate="{operation.aggregate}",'
+                    f'operation="{operation.operation}"'
+                )
+                histogram: DDDHistogram = getattr(operation, attribute)
+                for bound, count in histogram.cumulative():
+                    le = '+Inf' if bound == float('inf') else f'{bound:g}'
+                    lines.append(f'{metric}_bucket{{{labels},le="{le}"}} {count}')
+                lines.append(f'{metric}_sum{{{labels}}} {histogram.sum:g}')
+                lines.append(f'{metric}_count{{{labels}}} {histogram.count}')
+        metric = f'{self._prefix}_operation_errors_total'
+        lines.append(f'# HELP {metric} Repository operations that raised')
+        lines.append(f'# TYPE {metric} counter')
+        for operation in snapshot.operations:
+            lines.append(
+                f'{metric}{{aggregate="{operation.aggregate}",'
+                f'operation="{operation.operation}"}} {operation.errors}'
+            )
+        for name, kind, attribute, help in (
+            ('rows_hydrated_total', 'counter', 'rows_hydrated', 'Rows hydrated'),
+            ('identity_map_hits_total', 'counter', 'identity_map_hits', 'Hits'),
+            ('identity_map_misses_total', 'counter', 'identity_map_misses', 'Misses'),
+            (
+                'identity_map_evictions_total',
+                'counter',
+                'identity_map_evictions',
+                'Evictions',
+            ),
+            ('identity_map_hit_ratio', 'gauge', 'identity_map_hit_ratio', 'Hit ratio'),
+        ):
+            metric = f'{self._prefix}_{name}'
+            lines.append(f'# HELP {metric} {help}')
+            lines.append(f'# TYPE {metric} {kind}')
+            for aggregate in snapshot.aggregates:
+                lines.append(
+                    f'{metric}{{aggregate="{aggregate.aggregate}"}} '
+                    f'{getattr(aggregate, attribute):g}'
+                )
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,83 @@
+#  MIT License
+#
+#  Copyright (c) 2024 Mathieu Imfeld
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to deal
+#  in the Software without restriction, including without limitation the rights
+#  to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#  copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in all
+#  copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import typing
+
+import sqlalchemy
+import sqlalchemy.ext.asyncio
+from sqlalchemy.schema import CreateColumn
+
+from mhpython.ddd.base import DDDException
+
+
+async def upgrade_schema(
+    metadata: sqlalchemy.MetaData,
+    engine: sqlalchemy.ext.asyncio.AsyncEngine,
+) -> typing.Dict[str, typing.List[str]]:
+    """
+    Bring an existing database up to the tables of the metadata. create_all only creates missing
+    tables, so columns added to existing tables since, such as revision, updated_at,
+    network_start and network_end, are added using ALTER TABLE and missing indexes are created.
+    Added columns are NULL in existing rows. changes_since reports rows without revision for
+    watermark 0 only, networks must be backfilled using NetworkRepository.backfill_ranges to
+    be found by containing and overlapping.
+    Args:
+        metadata: The metadata describing the tables
+        engine: The engine of the existing database
+    Returns:
+        The names of the columns added per table
+    Raises:
+        DDDException: If a missing column can not be added because it is not nullable
+    """
+
+    def upgrade(conn: sqlalchemy.Connection) -> typing.Dict[str, typing.List[str]]:
+        inspector = sqlalchemy.inspect(conn)
+        existing = set(inspector.get_table_names())
+        added: typing.Dict[str, typing.List[str]] = {}
+        for table in metadata.sorted_tables:
+            if table.name not in existing:
+                continue
+            columns = {c['name'] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in columns:
+                    continue
+                if not column.nullable and column.server_default is None:
+                    raise DDDException(
+                        code=500,
+                        msg=f'Can not add the column {table.name}.{column.name} '
+                        'which is not nullable',
+                    )
+                conn.execute(
+                    sqlalchemy.text(
+                        f'ALTER TABLE {conn.dialect.identifier_preparer.format_table(table)} '
+                        f'ADD COLUMN {CreateColumn(column).compile(dialect=conn.dialect)}'
+                    )
+                )
+                added.setdefault(table.name, []).append(column.name)
+            indexes = {i['name'] for i in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in indexes:
+                    index.create(conn)
+        metadata.create_all(conn)
+        return added
+
+    async with engine.begin() as conn:
+        return await conn.run_sync(upgrade)
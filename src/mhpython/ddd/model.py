@@ -19,7 +19,7 @@
 #  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 #  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
-from sqlalchemy import ForeignKey, String
+from sqlalchemy import BigInteger, ForeignKey, Index, String
 from sqlalchemy.orm import Mapped, relationship, mapped_column
 
 from mhpython.ddd.base import DDDModel
@@ -27,9 +27,15 @@ from mhpython.ddd.base import DDDModel
 
 class NetworkModel(DDDModel):
     __tablename__ = 'networks'
+    __table_args__ = (
+        Index('ix_networks_network_start_network_end', 'network_start', 'network_end'),
+    )
     network: Mapped[str] = mapped_column(String(15))
     netmask: Mapped[str] = mapped_column(String(15))
     router: Mapped[str] = mapped_column(String(15))
+    # The first and last address of the network as integers, for index-backed containment
+    network_start: Mapped[int] = mapped_column(BigInteger, nullable=True)
+    network_end: Mapped[int] = mapped_column(BigInteger, nullable=True)
 
 
 class ImageModel(DDDModel):
@@ -44,9 +50,15 @@ class ClusterModel(DDDModel):
 
 class NodeModel(DDDModel):
     __tablename__ = 'nodes'
+    __table_args__ = (
+        Index('ix_nodes_network_uid_cluster_uid', 'network_uid', 'cluster_uid'),
+    )
+    # Covered by the (network_uid, cluster_uid) index
     network_uid: Mapped[str] = mapped_column(ForeignKey('networks.uid'))
-    image_uid: Mapped[str] = mapped_column(ForeignKey('images.uid'))
-    cluster_uid: Mapped[str] = mapped_column(ForeignKey('clusters.uid'), nullable=True)
+    image_uid: Mapped[str] = mapped_column(ForeignKey('images.uid'), index=True)
+    cluster_uid: Mapped[str] = mapped_column(
+        ForeignKey('clusters.uid'), nullable=True, index=True
+    )
 
     network: Mapped[NetworkModel] = relationship(lazy='selectin')
     image: Mapped[ImageModel] = relationship(lazy='selectin')
@@ -0,0 +1,223 @@
+#  MIT License
+#
+#  Copyright (c) 2024 Mathieu Imfeld
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to deal
+#  in the Software without restriction, including without limitation the rights
+#  to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#  copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in all
+#  copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import asyncio
+import json
+import time
+import typing
+
+import sqlalchemy.ext.asyncio
+from sqlalchemy import (
+    Column,
+    Float,
+    Integer,
+    String,
+    Table,
+    Text,
+    delete,
+    insert,
+    select,
+)
+from sqlalchemy.exc import SQLAlchemyError
+
+from mhpython.ddd.base import (
+    DDDException,
+    DDDModel,
+    DDDRepository,
+    UniqueIdentifier,
+)
+from mhpython.kafka.record import JsonCustomEncoder
+
+#
+# The outbox shares the metadata of the domain models so it is created alongside them
+
+outbox_table = Table(
+    'outbox',
+    DDDModel.metadata,
+    Column('id', Integer, primary_key=True, autoincrement=True),
+    Column('topic', String(255), nullable=False),
+    Column('key', String(64), nullable=False),
+    Column('payload', Text, nullable=False),
+    Column('created', Float, nullable=False),
+)
+
+
+class DDDOutbox:
+    """
+    A transactional outbox. Repositories configured with an outbox record an event for every
+    entity they create, modify or remove in the same transaction as the change itself, so that
+    events are published if and only if the change is committed.
+    """
+
+    def __init__(self, topic: str = 'ddd-events') -> None:
+        self._topic = topic
+
+    @property
+    def topic(self) -> str:
+        return self._topic
+
+    async def record(
+        self,
+        session: sqlalchemy.ext.asyncio.AsyncSession,
+        aggregate: str,
+        event: str,
+        changes: typing.Mapping[UniqueIdentifier, typing.Dict[str, typing.Any] | None],
+    ) -> None:
+        """
+        Record events within the transaction of the session
+        Args:
+            session: The session of the transaction persisting the changes
+            aggregate: The name of the aggregate, i.e. its table
+            event: One of created, modified or removed
+            changes: The column values of the changed entities by their uid, None for removals
+        """
+        created = time.time()
+        await session.execute(
+            insert(outbox_table),
+            [
+                {
+                    'topic': self._topic,
+                    'key': str(uid),
+                    'payload': json.dumps(
+                        {
+                            'aggregate': aggregate,
+                            'event': event,
+                            'uid': str(uid),
+                            'values': values,
+                        },
+                        cls=JsonCustomEncoder,
+                    ),
+                    'created': created,
+                }
+                for uid, values in changes.items()
+            ],
+        )
+
+
+class DDDOutboxProducer(typing.Protocol):
+    """
+    The subset of kafka.KafkaProducer used by the relay, configured with a transactional_id
+    """
+
+    def init_transactions(self) -> None: ...
+
+    def begin_transaction(self) -> None: ...
+
+    def send(self, topic: str, value: bytes, key: bytes) -> typing.Any: ...
+
+    def commit_transaction(self) -> None: ...
+
+    def abort_transaction(self) -> None: ...
+
+
+class DDDOutboxRelay:
+    """
+    Drains the outbox in batches and publishes each batch in a single Kafka transaction. Events
+    are removed from the outbox after their transaction committed, so delivery is at least once.
+    No database transaction is held open while publishing.
+    """
+
+    def __init__(
+        self,
+        session_maker: sqlalchemy.ext.asyncio.async_sessionmaker,
+        producer: DDDOutboxProducer,
+        batch_size: int = 500,
+    ) -> None:
+        self._session_maker = session_maker
+        self._producer = producer
+        self._batch_size = batch_size
+        self._initialised = False
+
+    def _publish(self, rows: typing.Sequence[sqlalchemy.Row]) -> None:
+        if not self._initialised:
+            self._producer.init_transactions()
+            self._initialised = True
+        self._producer.begin_transaction()
+        try:
+            for row in rows:
+                self._producer.send(
+                    topic=row.topic,
+                    value=row.payload.encode('utf-8'),
+                    key=row.key.encode('utf-8'),
+                )
+            self._producer.commit_transaction()
+        except Exception:
+            self._producer.abort_transaction()
+            raise
+
+    async def drain_once(self) -> int:
+        """
+        Publish a single batch of events
+        Returns:
+            The number of events published
+        """
+        try:
+            async with self._session_maker() as session:
+                rows = (
+                    await session.execute(
+                        select(outbox_table)
+                        .order_by(outbox_table.c.id)
+                        .limit(self._batch_size)
+                    )
+                ).all()
+        except SQLAlchemyError as sae:
+            raise DDDException(code=500, msg='Failure reading the outbox') from sae
+        if len(rows) == 0:
+            return 0
+        # The producer blocks, so keep it off the event loop and outside any transaction
+        await asyncio.to_thread(self._publish, rows)
+        ids = [row.id for row in rows]
+        try:
+            # Delete exactly what was published. Ids are assigned on insert rather than on
+            # commit, so a range would also delete events committed after the batch was read
+            async with self._session_maker() as session, session.begin():
+                for offset in range(0, len(ids), DDDRepository.chunk_size):
+                    await session.execute(
+                        delete(outbox_table).where(
+                            outbox_table.c.id.in_(
+                                ids[offset : offset + DDDRepository.chunk_size]
+                            )
+                        )
+                    )
+        except SQLAlchemyError as sae:
+            raise DDDException(
+                code=500, msg='Failure removing published events from the outbox'
+            ) from sae
+        return len(rows)
+
+    async def drain(self) -> int:
+        """
+        Publish batches until the outbox is empty
+        Returns:
+            The number of events published
+        """
+        published = 0
+        while (count := await self.drain_once()) > 0:
+            published += count
+        return published
+
+    async def run(self, interval: float = 1.0) -> None:
+        """
+        Drain the outbox continuously, pausing for interval seconds whenever it is empty
+        """
+        while True:
+            if await self.drain() == 0:
+                await asyncio.sleep(interval)
@@ -19,16 +19,29 @@
 #  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 #  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
+import ipaddress
 import pathlib
+import typing
 
-from mhpython.ddd.base import DDDRepository
+from sqlalchemy import ColumnElement, and_, or_, select, update
+from sqlalchemy.exc import SQLAlchemyError
+
+from mhpython.ddd.base import (
+    DDDException,
+    DDDRepository,
+    EntityInvariantException,
+    UniqueIdentifier,
+    hydration_scope,
+)
 from mhpython.ddd.domain import (
     ImageEntity,
     NetworkEntity,
     ClusterEntity,
+    NodeCollection,
     NodeEntity,
 )
 from mhpython.ddd.model import ImageModel, NetworkModel, ClusterModel, NodeModel
+from mhpython.ddd.specification import Equals
 
 
 class ImageRepository(DDDRepository[ImageEntity, ImageModel]):
@@ -72,8 +85,123 @@ class NetworkRepository(DDDRepository[NetworkEntity, NetworkModel]):
         model.network = entity.network
         model.netmask = entity.netmask
         model.router = entity.router
+        network = cls._ip_network(f'{entity.network}/{entity.netmask}')
+        model.network_start = int(network.network_address)
+        model.network_end = int(network.broadcast_address)
         return model
 
+    async def containing(
+        self, ip: str | ipaddress.IPv4Address
+    ) -> typing.List[NetworkEntity]:
+        """
+        Find the networks containing an address, the most specific network first. Networks are
+        looked up by their network address for every prefix length instead of scanning a range.
+        Args:
+            ip: The address
+        Returns:
+            The networks containing the address
+        """
+        try:
+            address = int(ipaddress.IPv4Address(ip))
+        except ValueError as ve:
+            raise EntityInvariantException(
+                code=400, msg=f'Invalid address {ip}'
+            ) from ve
+        return await self._in_range(self._containing(address))
+
+    async def overlapping(
+        self, cidr: str | ipaddress.IPv4Network
+    ) -> typing.List[NetworkEntity]:
+        """
+        Find the networks overlapping a network in CIDR notation, the most specific first. Since
+        networks either nest or are disjoint, these are the networks containing its network
+        address and the networks starting within it.
+        Args:
+            cidr: The network, e.g. 172.16.0.0/16
+        Returns:
+            The networks sharing at least one address with the network
+        """
+        network = self._ip_network(cidr)
+        start = int(network.network_address)
+        end = int(network.broadcast_address)
+        return await self._in_range(
+            or_(
+                self._containing(start),
+                NetworkModel.network_start.between(start, end),
+            )
+        )
+
+    async def backfill_ranges(self) -> int:
+        """
+        Store the first and last address of networks persisted before the columns existed, after
+        they have been added by upgrade_schema, so that containing and overlapping find them
+        Returns:
+            The number of networks backfilled
+        """
+        query = select(
+            NetworkModel.uid, NetworkModel.network, NetworkModel.netmask
+        ).where(NetworkModel.network_start.is_(None))
+        try:
+            async with self._write_session_maker()() as session, session.begin():
+                rows = (await session.execute(query)).all()
+                for chunk in self._chunks(rows):
+                    values = []
+                    for uid, network, netmask in chunk:
+                        ip_network = self._ip_network(f'{network}/{netmask}')
+                        values.append(
+                            {
+                                'uid': uid,
+                                'network_start': int(ip_network.network_address),
+                                'network_end': int(ip_network.broadcast_address),
+                            }
+                        )
+                    await session.execute(update(NetworkModel), values)
+        except SQLAlchemyError as sae:
+            raise DDDException(
+                code=500, msg='Failure backfilling the network ranges'
+            ) from sae
+        await self._written([UniqueIdentifier(str(row.uid)) for row in rows])
+        return len(rows)
+
+    @staticmethod
+    def _containing(address: int) -> ColumnElement[bool]:
+        # network_start is the network address, i.e. aligned to the netmask, so a network
+        # containing the address starts at the address masked to its prefix length
+        starts = {
+            address & (0xFFFFFFFF << (32 - length)) & 0xFFFFFFFF for length in range(33)
+        }
+        return and_(
+            NetworkModel.network_start.in_(sorted(starts)),
+            NetworkModel.network_end >= address,
+        )
+
+    async def _in_range(
+        self, condition: ColumnElement[bool]
+    ) -> typing.List[NetworkEntity]:
+        query = (
+            select(NetworkModel)
+            .where(condition)
+            .order_by(NetworkModel.network_start.desc(), NetworkModel.network_end)
+        )
+        try:
+            async with self._read_session_maker()() as session:
+                models = (await session.scalars(query)).all()
+                with hydration_scope():
+                    return [await self._hydrate(m) for m in models]
+        except SQLAlchemyError as sae:
+            raise DDDException(
+                code=500, msg='Failure finding networks in persistence'
+            ) from sae
+
+    @staticmethod
+    def _ip_network(cidr: str | ipaddress.IPv4Network) -> ipaddress.IPv4Network:
+        try:
+            return ipaddress.IPv4Network(cidr, strict=False)
+        except ValueError as ve:
+            raise EntityInvariantException(
+                code=400, msg=f'Invalid network {cidr}'
+            ) from ve
+
 
 class ClusterRepository(DDDRepository[ClusterEntity, ClusterModel]):
     entity_class = ClusterEntity
@@ -82,6 +210,12 @@ class ClusterRepository(DDDRepository[ClusterEntity, ClusterModel]):
     @classmethod
     async def from_model(cls, model: ClusterModel, *args, **kwargs) -> ClusterEntity:
         entity = await super().from_model(model, *args, **kwargs)
+        entity._nodes = NodeCollection(
+            entity,
+            loader=lambda: NodeEntity.repository.find(
+                Equals('cluster_uid', entity.uid)
+            ),
+        )
         return entity
 
     @classmethod
@@ -98,12 +232,15 @@ class NodeRepository(DDDRepository[NodeEntity, NodeModel]):
 
     @classmethod
     async def from_model(cls, model: NodeModel, *args, **kwargs) -> NodeEntity:
-        kwargs['network'] = await NetworkRepository.from_model(model.network)
-        kwargs['image'] = await ImageRepository.from_model(model.image)
+        kwargs['network'] = await NetworkRepository.resolve(
+            model.network, model.network_uid
+        )
+        kwargs['image'] = await ImageRepository.resolve(model.image, model.image_uid)
         entity = await super().from_model(model, *args, **kwargs)
-        entity._network = await NetworkRepository.from_model(model.network)
         if model.cluster_uid is not None:
-            entity._cluster = await ClusterRepository.from_model(model.cluster)
+            entity._cluster = await ClusterRepository.resolve(
+                model.cluster, model.cluster_uid
+            )
         return entity
 
     @classmethod
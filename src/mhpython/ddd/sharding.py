@@ -0,0 +1,287 @@
+#  MIT License
+#
+#  Copyright (c) 2024 Mathieu Imfeld
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to deal
+#  in the Software without restriction, including without limitation the rights
+#  to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#  copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in all
+#  copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import asyncio
+import contextvars
+import hashlib
+import typing
+import uuid
+
+import sqlalchemy.ext.asyncio
+
+from mhpython.ddd.base import (
+    DDDException,
+    DDDRepository,
+    EntityNotFoundException,
+    T_DDDEntity,
+    T_DDDModel,
+    UniqueIdentifier,
+)
+from mhpython.ddd.cache import DDDCache
+from mhpython.ddd.identity_map import DDDIdentityMap
+
+if typing.TYPE_CHECKING:
+    from mhpython.ddd.metrics import DDDMetrics
+    from mhpython.ddd.specification import DDDSpecification
+
+#
+# The shard the current operation runs against
+
+_shard: contextvars.ContextVar[int | None] = contextvars.ContextVar(
+    'ddd_shard', default=None
+)
+
+
+class DDDShardedRepository(DDDRepository[T_DDDEntity, T_DDDModel]):
+    """
+    A repository spreading its aggregates over several databases by a hash of their uid. Point
+    operations go to the owning shard only, list, stream, find and count fan out to all shards
+    concurrently and merge the results. Mix it into a concrete repository:
+
+    class ShardedNetworkRepository(DDDShardedRepository, NetworkRepository):
+        pass
+
+    Related aggregates, such as the networks and images of sharded nodes, usually live in other
+    databases or shards. Relationships are still loaded from the shard of the aggregate, but
+    whatever is not found there is loaded through the repository of the related aggregate, see
+    DDDRepository.resolve. The schemas of the shards must hence not enforce foreign keys to
+    aggregates stored elsewhere.
+
+    Limitations:
+    * Units of work and group commits span a single database and are not supported, writes are
+      committed immediately on their shard
+    * Pages, change feeds and repository-specific queries are not supported across shards
+    """
+
+    def __init__(
+        self,
+        session_makers: typing.Sequence[sqlalchemy.ext.asyncio.async_sessionmaker],
+        identity_map: DDDIdentityMap | None = None,
+        cache: DDDCache | None = None,
+        metrics: typing.Optional['DDDMetrics'] = None,
+    ) -> None:
+        """
+        Args:
+            session_makers: The session makers of the shards. Changing their number or order
+                relocates aggregates, so it requires migrating the data
+            identity_map: The identity map to use, shared by all shards
+            cache: An optional second-level cache
+            metrics: Optional metrics to record the operations of every shard into
+        """
+        if len(session_makers) == 0:
+            raise DDDException(
+                code=500, msg='Misconfigured DDDShardedRepository without shards'
+            )
+        self._shards = tuple(session_makers)
+        super().__init__(session_makers[0], identity_map=identity_map, cache=cache)
+        self._session_makers = self._shards
+        # Not a session maker, so that no unit of work ever considers this repository
+        self._session_maker = None
+        # Registered once the shards are known, so that statements on all of them are counted
+        self._metrics = metrics
+        if metrics is not None:
+            metrics.register(self)
+
+    @property
+    def shards(self) -> int:
+        return len(self._shards)
+
+    def shard(self, uid: UniqueIdentifier) -> int:
+        """
+        Return the index of the shard owning an aggregate
+        """
+        digest = hashlib.blake2b(uuid.UUID(str(uid)).bytes, digest_size=8).digest()
+        return int.from_bytes(digest, 'big') % len(self._shards)
+
+    def _read_session_maker(self) -> sqlalchemy.ext.asyncio.async_sessionmaker:
+        return self._write_session_maker()
+
+    def _write_session_maker(self) -> sqlalchemy.ext.asyncio.async_sessionmaker:
+        shard = _shard.get()
+        if shard is None:
+            raise DDDException(
+                code=500,
+                msg=f'{self.__class__.__name__} does not support this operation across shards',
+            )
+        return self._shards[shard]
+
+    async def _on(
+        self,
+        shard: int,
+        operation: typing.Callable[..., typing.Awaitable[typing.Any]],
+        *args,
+        **kwargs,
+    ) -> typing.Any:
+        token = _shard.set(shard)
+        try:
+            return await operation(*args, **kwargs)
+        finally:
+            _shard.reset(token)
+
+    async def _everywhere(
+        self,
+        operation: typing.Callable[..., typing.Awaitable[typing.Any]],
+        *args,
+        **kwargs,
+    ) -> typing.List[typing.Any]:
+        return await asyncio.gather(
+            *[
+                self._on(shard, operation, *args, **kwargs)
+                for shard in range(0, len(self._shards))
+            ]
+        )
+
+    def _by_shard(
+        self, entities: typing.Iterable[typing.Any], uid: typing.Callable = lambda e: e
+    ) -> typing.Dict[int, typing.List[typing.Any]]:
+        shards: typing.Dict[int, typing.List[typing.Any]] = {}
+        for entity in entities:
+            shards.setdefault(self.shard(uid(entity)), []).append(entity)
+        return shards
+
+    async def _load(self, uid: UniqueIdentifier) -> T_DDDEntity:
+        return await self._on(self.shard(uid), super()._load, uid)
+
+    async def get_many(
+        self, uids: typing.Iterable[UniqueIdentifier], missing_ok: bool = False
+    ) -> typing.List[T_DDDEntity]:
+        get_many = super().get_many
+        uids = list(uids)
+        found = {
+            entity.uid: entity
+            for entities in await asyncio.gather(
+                *[
+                    self._on(shard, get_many, group, missing_ok=True)
+                    for shard, group in self._by_shard(dict.fromkeys(uids)).items()
+                ]
+            )
+            for entity in entities
+        }
+        missing = [uid for uid in uids if uid not in found]
+        if len(missing) > 0 and not missing_ok:
+            raise EntityNotFoundException(
+                msg=f'{len(missing)} of the specified entities do not exist'
+            )
+        return [found[uid] for uid in uids if uid in found]
+
+    async def list(self) -> typing.List[T_DDDEntity]:
+        return [
+            entity
+            for entities in await self._everywhere(super().list)
+            for entity in entities
+        ]
+
+    async def stream(
+        self, chunk_size: int | None = None
+    ) -> typing.AsyncIterator[T_DDDEntity]:
+        """
+        Stream the entities of all shards concurrently, in no particular order. Each shard
+        buffers at most one chunk ahead of the consumer.
+        """
+        queue: asyncio.Queue = asyncio.Queue(maxsize=len(self._shards))
+        done = object()
+        stream = super().stream
+
+        async def produce(shard: int) -> None:
+            token = _shard.set(shard)
+            try:
+                chunk = []
+                async for entity in stream(chunk_size):
+                    chunk.append(entity)
+                    if len(chunk) == (chunk_size or self.chunk_size):
+                        await queue.put(chunk)
+                        chunk = []
+                await queue.put(chunk)
+            finally:
+                _shard.reset(token)
+
+        async def produce_all() -> None:
+            try:
+                await asyncio.gather(
+                    *[produce(shard) for shard in range(0, len(self._shards))]
+                )
+            finally:
+                await queue.put(done)
+
+        producer = asyncio.create_task(produce_all())
+        try:
+            while (chunk := await queue.get()) is not done:
+                for entity in chunk:
+                    yield entity
+            await producer
+        finally:
+            producer.cancel()
+
+    async def find(
+        self, specification: 'DDDSpecification', limit: int | None = None
+    ) -> typing.List[T_DDDEntity]:
+        entities = [
+            entity
+            for found in await self._everywhere(super().find, specification, limit)
+            for entity in found
+        ]
+        if limit is None:
+            return entities
+        return sorted(entities, key=lambda e: str(e.uid))[:limit]
+
+    async def count(
+        self, specification: typing.Optional['DDDSpecification'] = None
+    ) -> int:
+        return sum(await self._everywhere(super().count, specification))
+
+    async def create(self, entity: T_DDDEntity) -> T_DDDEntity:
+        return await self._on(self.shard(entity.uid), super().create, entity)
+
+    async def create_many(
+        self, entities: typing.Iterable[T_DDDEntity]
+    ) -> typing.List[T_DDDEntity]:
+        """
+        Create multiple entities in a transaction per shard. The shards are written concurrently,
+        so a failure on one shard does not roll back the others.
+        """
+        entities = list(entities)
+        create_many = super().create_many
+        await asyncio.gather(
+            *[
+                self._on(shard, create_many, group)
+                for shard, group in self._by_shard(entities, lambda e: e.uid).items()
+            ]
+        )
+        return entities
+
+    async def modify(self, entity: T_DDDEntity) -> T_DDDEntity:
+        return await self._on(self.shard(entity.uid), super().modify, entity)
+
+    async def remove(self, entity: T_DDDEntity) -> None:
+        await self._on(self.shard(entity.uid), super().remove, entity)
+
+    async def remove_many(self, entities: typing.Iterable[T_DDDEntity]) -> None:
+        """
+        Remove multiple entities in a transaction per shard. The shards are written concurrently,
+        so a failure on one shard does not roll back the others.
+        """
+        remove_many = super().remove_many
+        await asyncio.gather(
+            *[
+                self._on(shard, remove_many, group)
+                for shard, group in self._by_shard(entities, lambda e: e.uid).items()
+            ]
+        )
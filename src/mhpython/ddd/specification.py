@@ -0,0 +1,142 @@
+#  MIT License
+#
+#  Copyright (c) 2024 Mathieu Imfeld
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to deal
+#  in the Software without restriction, including without limitation the rights
+#  to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#  copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in all
+#  copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import abc
+import dataclasses
+import typing
+
+import sqlalchemy
+from sqlalchemy import and_, or_
+
+from mhpython.ddd.base import (
+    DDDEntity,
+    DDDModel,
+    DDDRepository,
+    EntityInvariantException,
+    starts_with,
+)
+
+
+class DDDSpecification(abc.ABC):
+    """
+    Base class for composable query specifications. A repository compiles a specification into a
+    single SQL WHERE clause over the columns of its model. Specifications are combined using the
+    & and | operators.
+    """
+
+    @abc.abstractmethod
+    def compile(
+        self, model_class: typing.Type[DDDModel]
+    ) -> sqlalchemy.ColumnElement[bool]:
+        pass
+
+    def __and__(self, other: 'DDDSpecification') -> 'And':
+        return And(self, other)
+
+    def __or__(self, other: 'DDDSpecification') -> 'Or':
+        return Or(self, other)
+
+    @staticmethod
+    def column(
+        model_class: typing.Type[DDDModel], field: str
+    ) -> sqlalchemy.ColumnElement:
+        if field not in model_class.__table__.columns:
+            raise EntityInvariantException(
+                code=400, msg=f'{model_class.__name__} has no column {field}'
+            )
+        return getattr(model_class, field)
+
+    @staticmethod
+    def bind(value: typing.Any) -> typing.Any:
+        # Entities are matched by their unique identifier, e.g. Equals('network_uid', network)
+        return str(value.uid) if isinstance(value, DDDEntity) else value
+
+
+@dataclasses.dataclass(frozen=True)
+class Equals(DDDSpecification):
+    field: str
+    value: typing.Any
+
+    def compile(
+        self, model_class: typing.Type[DDDModel]
+    ) -> sqlalchemy.ColumnElement[bool]:
+        column = self.column(model_class, self.field)
+        if self.value is None:
+            return column.is_(None)
+        return column == self.bind(self.value)
+
+
+@dataclasses.dataclass(frozen=True)
+class In(DDDSpecification):
+    field: str
+    values: typing.Tuple[typing.Any, ...]
+
+    def __init__(self, field: str, values: typing.Iterable[typing.Any]) -> None:
+        object.__setattr__(self, 'field', field)
+        object.__setattr__(self, 'values', tuple(values))
+
+    def compile(
+        self, model_class: typing.Type[DDDModel]
+    ) -> sqlalchemy.ColumnElement[bool]:
+        column = self.column(model_class, self.field)
+        values = [self.bind(v) for v in self.values]
+        if len(values) <= DDDRepository.chunk_size:
+            return column.in_(values)
+        # Keep the number of bound parameters per IN list within the limits of the database
+        return or_(*[column.in_(chunk) for chunk in DDDRepository._chunks(values)])
+
+
+@dataclasses.dataclass(frozen=True)
+class Prefix(DDDSpecification):
+    field: str
+    prefix: str
+
+    def compile(
+        self, model_class: typing.Type[DDDModel]
+    ) -> sqlalchemy.ColumnElement[bool]:
+        column = self.column(model_class, self.field)
+        return starts_with(column, self.prefix)
+
+
+@dataclasses.dataclass(frozen=True)
+class And(DDDSpecification):
+    specifications: typing.Tuple[DDDSpecification, ...]
+
+    def __init__(self, *specifications: DDDSpecification) -> None:
+        object.__setattr__(self, 'specifications', specifications)
+
+    def compile(
+        self, model_class: typing.Type[DDDModel]
+    ) -> sqlalchemy.ColumnElement[bool]:
+        return and_(*[s.compile(model_class) for s in self.specifications])
+
+
+@dataclasses.dataclass(frozen=True)
+class Or(DDDSpecification):
+    specifications: typing.Tuple[DDDSpecification, ...]
+
+    def __init__(self, *specifications: DDDSpecification) -> None:
+        object.__setattr__(self, 'specifications', specifications)
+
+    def compile(
+        self, model_class: typing.Type[DDDModel]
+    ) -> sqlalchemy.ColumnElement[bool]:
+        return or_(*[s.compile(model_class) for s in self.specifications])
@@ -0,0 +1,136 @@
+#  MIT License
+#
+#  Copyright (c) 2024 Mathieu Imfeld
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to deal
+#  in the Software without restriction, including without limitation the rights
+#  to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#  copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in all
+#  copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import os
+import time
+import typing
+import uuid
+
+import sqlalchemy
+import sqlalchemy.ext.asyncio
+from sqlalchemy import UUID, LargeBinary, String, insert, select
+from sqlalchemy.types import TypeDecorator
+
+
+def uuid7() -> uuid.UUID:
+    """
+    Generate a time-ordered UUID as per RFC 9562 version 7. The leading 48 bits hold the Unix
+    timestamp in milliseconds so that consecutive identifiers land next to each other in a B-tree
+    index rather than being scattered across its pages.
+    Returns:
+        A version 7 UUID
+    """
+    timestamp_ms = time.time_ns() // 1_000_000
+    value = (timestamp_ms & 0xFFFF_FFFF_FFFF) << 80
+    value |= int.from_bytes(os.urandom(10), 'big')
+    value &= ~(0xF << 76)
+    value |= 0x7 << 76
+    value &= ~(0x3 << 62)
+    value |= 0x2 << 62
+    return uuid.UUID(int=value)
+
+
+def use_binary_uids(
+    engine: sqlalchemy.Engine | sqlalchemy.ext.asyncio.AsyncEngine,
+) -> None:
+    """
+    Store unique identifiers as compact 16-byte binary values in databases reached through the
+    provided engine rather than as text. This only affects dialects without a native UUID type,
+    notably SQLite. It must be called before any statement is executed and the database must
+    not already contain string identifiers, use migrate_uids to convert those.
+    Args:
+        engine: The engine to configure
+    """
+    engine.dialect.ddd_binary_uids = True
+
+
+def binary_uids(dialect: sqlalchemy.Dialect) -> bool:
+    return getattr(dialect, 'ddd_binary_uids', False)
+
+
+class DDDUniqueIdentifierType(TypeDecorator):
+    """
+    Column type for unique identifiers. Uses the native UUID type where the database has one,
+    otherwise stores the textual form or, if enabled via use_binary_uids, the 16 raw bytes.
+    Values are bound from either UUIDs or strings and always returned as strings.
+    """
+
+    impl = String(32)
+    cache_ok = True
+
+    def load_dialect_impl(
+        self, dialect: sqlalchemy.Dialect
+    ) -> sqlalchemy.types.TypeEngine:
+        if dialect.name == 'postgresql':
+            return dialect.type_descriptor(UUID(as_uuid=False))
+        if binary_uids(dialect):
+            return dialect.type_descriptor(LargeBinary(16))
+        return dialect.type_descriptor(String(32))
+
+    def process_bind_param(
+        self, value: typing.Any, dialect: sqlalchemy.Dialect
+    ) -> typing.Any:
+        if value is None:
+            return None
+        uid = value if isinstance(value, uuid.UUID) else uuid.UUID(str(value))
+        if dialect.name != 'postgresql' and binary_uids(dialect):
+            return uid.bytes
+        return str(uid)
+
+    def process_result_value(
+        self, value: typing.Any, dialect: sqlalchemy.Dialect
+    ) -> str | None:
+        if value is None:
+            return None
+        if isinstance(value, bytes):
+            return str(uuid.UUID(bytes=value))
+        return str(value)
+
+
+async def migrate_uids(
+    metadata: sqlalchemy.MetaData,
+    source: sqlalchemy.ext.asyncio.AsyncEngine,
+    target: sqlalchemy.ext.asyncio.AsyncEngine,
+    chunk_size: int = 500,
+) -> typing.Dict[str, int]:
+    """
+    Copy all tables of the metadata from a source to a target database, converting the
+    identifiers to whatever layout the target engine is configured for. Tables are copied in
+    foreign key dependency order. The target tables are created if they do not exist.
+    Args:
+        metadata: The metadata describing the tables to copy
+        source: The engine of the existing database
+        target: The engine of the new database
+        chunk_size: The number of rows to copy per statement
+    Returns:
+        The number of rows copied per table
+    """
+    copied: typing.Dict[str, int] = {}
+    async with target.begin() as conn:
+        await conn.run_sync(metadata.create_all)
+    async with source.connect() as src, target.begin() as dst:
+        for table in metadata.sorted_tables:
+            copied[table.name] = 0
+            result = await src.stream(select(table))
+            async for rows in result.partitions(chunk_size):
+                await dst.execute(insert(table), [row._asdict() for row in rows])
+                copied[table.name] += len(rows)
+    return copied
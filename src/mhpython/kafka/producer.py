@@ -21,6 +21,7 @@
 
 import sys
 import time
+import typing
 import uuid
 import argparse
 
@@ -31,6 +32,31 @@ from mhpython import __version__
 from .record import DataclassRecord, RegionEnum
 
 
+def create_transactional_producer(
+    bootstrap: typing.List[str], client_id: str, transactional_id: str, **kwargs
+) -> kafka.KafkaProducer:
+    """
+    Create a producer for transactional, batched sends of pre-serialised records, e.g. to relay
+    the mhpython.ddd outbox
+    Args:
+        bootstrap: Kafka bootstrap servers
+        client_id: Kafka client ID
+        transactional_id: Kafka transactional ID, must be stable across restarts of the producer
+        **kwargs: Further configuration passed to kafka.KafkaProducer
+    Returns:
+        The producer, transactions are not yet initialised
+    """
+    kwargs.setdefault('acks', 'all')
+    kwargs.setdefault('linger_ms', 5)
+    kwargs.setdefault('batch_size', 256 * 1024)
+    return kafka.KafkaProducer(
+        bootstrap_servers=bootstrap,
+        client_id=client_id,
+        transactional_id=transactional_id,
+        **kwargs,
+    )
+
+
 def main() -> int:
     parser = argparse.ArgumentParser(f'Kafka Producer -- {__version__}')
     parser.add_argument(
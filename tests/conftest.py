@@ -28,6 +28,7 @@ import sqlalchemy.ext.asyncio
 import sqlalchemy.orm
 
 import mhpython.ddd.base
+from mhpython.ddd.metrics import DDDQueryRecorder
 from mhpython.ddd.domain import NodeEntity, ImageEntity, NetworkEntity
 from mhpython.ddd.repository import (
     ImageRepository,
@@ -64,6 +65,20 @@ async def async_session_maker(
     await engine.dispose()
 
 
+@pytest.fixture
+def query_budget(async_session_maker) -> typing.Callable[..., DDDQueryRecorder]:
+    """
+    Record the statements executed through the session maker of the tests
+    Returns:
+        A callable returning a DDDQueryRecorder for an optional budget, to be used as a context
+    """
+
+    def recorder(budget: int | None = None) -> DDDQueryRecorder:
+        return DDDQueryRecorder(async_session_maker, budget=budget)
+
+    return recorder
+
+
 @pytest_asyncio.fixture
 async def image_repository(async_session_maker) -> ImageRepository:
     return ImageRepository(async_session_maker)
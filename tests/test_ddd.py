@@ -19,14 +19,51 @@
 #  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 #  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
+import asyncio
+import base64
+import contextvars
+import gc
+import ipaddress
+import json
+import sqlite3
+import threading
 import uuid
 
 import pytest
+import pytest_asyncio
+import sqlalchemy
+import sqlalchemy.ext.asyncio
 from mhpython.ddd.base import (
+    DDDException,
+    DDDGroupCommit,
+    DDDModel,
+    DDDUnitOfWork,
     EntityNotFoundException,
     EntityInvariantException,
+    _primary_pins,
 )
-from mhpython.ddd.domain import ClusterEntity
+from mhpython.ddd.benchmark import compare
+from mhpython.ddd.cache import (
+    DDDBloomFilter,
+    DDDLRUCache,
+    DDDNegativeCache,
+    DDDSQLiteCache,
+)
+from mhpython.ddd.domain import ClusterEntity, ImageEntity, NetworkEntity, NodeEntity
+from mhpython.ddd.metrics import (
+    DDDMetrics,
+    DDDQueryBudgetExceeded,
+    DDDQueryRecorder,
+    DDDTextExporter,
+)
+from mhpython.ddd.model import NetworkModel, NodeModel
+from mhpython.ddd.identity_map import DDDLRUIdentityMap, DDDWeakIdentityMap
+from mhpython.ddd.migration import upgrade_schema
+from mhpython.ddd.outbox import DDDOutbox, DDDOutboxRelay, outbox_table
+from mhpython.ddd.repository import ImageRepository, NetworkRepository, NodeRepository
+from mhpython.ddd.sharding import DDDShardedRepository
+from mhpython.ddd.specification import Equals, In, Prefix
+from mhpython.ddd.uid import migrate_uids, use_binary_uids, uuid7
 
 
 @pytest.mark.asyncio
@@ -154,3 +191,1384 @@ async def test_rename_cluster(cluster_repository):
     loaded = await cluster_repository.get_by_uid(cluster.uid)
     assert not loaded.dirty
     assert loaded == cluster
+
+
+@pytest.mark.asyncio
+async def test_get_many(seed_nodes, node_repository):
+    """
+    Test whether multiple entities can be fetched at once, in the requested order
+    """
+    node_repository._identity_map.clear()
+    uids = [node.uid for node in reversed(seed_nodes)]
+    loaded = await node_repository.get_many(uids)
+    assert [node.uid for node in loaded] == uids
+    assert loaded == list(reversed(seed_nodes))
+    assert all(uid in node_repository._identity_map for uid in uids)
+
+
+@pytest.mark.asyncio
+async def test_get_many_missing(seed_nodes, node_repository):
+    """
+    Test whether missing entities raise unless they are explicitly permitted
+    """
+    uids = [seed_nodes[0].uid, uuid.uuid4(), seed_nodes[1].uid]
+    with pytest.raises(
+        EntityNotFoundException,
+        match='\\[404\\] 1 of the specified entities do not exist',
+    ):
+        await node_repository.get_many(uids)
+    loaded = await node_repository.get_many(uids, missing_ok=True)
+    assert [node.uid for node in loaded] == [seed_nodes[0].uid, seed_nodes[1].uid]
+
+
+@pytest.mark.asyncio
+async def test_stream(seed_nodes, node_repository, async_session_maker):
+    """
+    Test whether entities can be streamed in chunks and only feed bounded identity maps
+    """
+    known = await node_repository.get_by_uid(seed_nodes[0].uid)
+    node_repository._identity_map.clear()
+    node_repository._identity_map[known.uid] = known
+    streamed = [node async for node in node_repository.stream(chunk_size=2)]
+    assert sorted(node.uid for node in streamed) == sorted(
+        node.uid for node in seed_nodes
+    )
+    assert known in streamed
+    assert list(node_repository._identity_map) == [known.uid]
+
+    bounded = NodeRepository(async_session_maker, identity_map=DDDLRUIdentityMap())
+    streamed = [node async for node in bounded.stream(chunk_size=2)]
+    for node in streamed:
+        assert await bounded.get_by_uid(node.uid) is node
+
+
+@pytest.mark.asyncio
+async def test_page(seed_nodes, node_repository):
+    """
+    Test whether entities can be paged through using the opaque cursor
+    """
+    first = await node_repository.page(limit=2, order_by='name')
+    assert [node.name for node in first.entities] == ['Node-0', 'Node-1']
+    assert first.cursor is not None
+    second = await node_repository.page(limit=2, order_by='name', cursor=first.cursor)
+    assert [node.name for node in second.entities] == ['Node-2']
+    assert second.cursor is None
+
+    by_uid = await node_repository.page(limit=10)
+    assert [node.uid for node in by_uid.entities] == sorted(
+        (node.uid for node in seed_nodes), key=str
+    )
+    with pytest.raises(
+        EntityInvariantException,
+        match='\\[400\\] The cursor was issued for a different ordering',
+    ):
+        await node_repository.page(cursor=first.cursor)
+    with pytest.raises(EntityInvariantException, match='\\[400\\] Pages must hold'):
+        await node_repository.page(limit=0)
+    for tampered in (
+        ['name', 'Node-1', 'not a uid'],
+        ['name', 'Node-1', 42],
+        ['name', {'$gt': ''}, str(seed_nodes[0].uid)],
+        'not a list',
+    ):
+        cursor = base64.urlsafe_b64encode(json.dumps(tampered).encode()).decode()
+        with pytest.raises(EntityInvariantException, match='\\[400\\] Invalid cursor'):
+            await node_repository.page(order_by='name', cursor=cursor)
+
+
+def test_name_uid_index():
+    """
+    Test whether every table is indexed in the keyset order of pages
+    """
+    for model in (NetworkModel, NodeModel):
+        indexes = {
+            index.name: [c.name for c in index.columns]
+            for index in model.__table__.indexes
+        }
+        assert indexes[f'ix_{model.__tablename__}_name_uid'] == ['name', 'uid']
+    # Lookups by network use the leading column of the (network_uid, cluster_uid) index
+    assert 'ix_nodes_network_uid' not in {i.name for i in NodeModel.__table__.indexes}
+
+
+@pytest.mark.asyncio
+async def test_page_filtered(seed_nodes, seed_networks, node_repository):
+    """
+    Test whether pages can be filtered by equality and prefix
+    """
+    page = await node_repository.page(prefixes={'name': 'Node-1'})
+    assert [node.uid for node in page.entities] == [seed_nodes[1].uid]
+    page = await node_repository.page(
+        filters={'network_uid': str(seed_networks[0].uid)}
+    )
+    assert len(page.entities) == 3
+    page = await node_repository.page(
+        filters={'network_uid': str(seed_networks[1].uid)}
+    )
+    assert len(page.entities) == 0
+    with pytest.raises(
+        EntityInvariantException, match='\\[400\\] NodeModel has no column foo'
+    ):
+        await node_repository.page(filters={'foo': 'bar'})
+
+
+@pytest.mark.asyncio
+async def test_create_many(network_repository):
+    """
+    Test whether many entities can be created in a single transaction
+    """
+    networks = [
+        NetworkEntity(
+            name=f'Network {i}',
+            network=f'10.0.{i}.0',
+            netmask='255.255.255.0',
+            router=f'10.0.{i}.1',
+        )
+        for i in range(0, 100)
+    ]
+    created = await NetworkEntity.save_many(networks)
+    assert created == networks
+    assert not any(network.dirty for network in networks)
+    network_repository._identity_map.clear()
+    loaded = await network_repository.get_many([network.uid for network in networks])
+    assert loaded == networks
+
+    loaded[0].name = 'Renamed Network'
+    await network_repository.create_many(loaded[0:2])
+    assert not loaded[0].dirty
+    network_repository._identity_map.clear()
+    assert (
+        await network_repository.get_by_uid(loaded[0].uid)
+    ).name == 'Renamed Network'
+    for network in loaded:
+        await network_repository.remove(network)
+
+
+@pytest.mark.asyncio
+async def test_create_many_failing_hook(network_repository, monkeypatch):
+    """
+    Test whether a failing post_create hook leaves the other committed entities persisted
+    """
+    networks = [
+        NetworkEntity(
+            name=f'Hooked Network {i}',
+            network=f'10.15.{i}.0',
+            netmask='255.255.255.0',
+            router=f'10.15.{i}.1',
+        )
+        for i in range(0, 3)
+    ]
+
+    async def failing_post_create(self):
+        raise EntityInvariantException(code=400, msg='Hook failed')
+
+    monkeypatch.setattr(NetworkEntity, 'post_create', failing_post_create)
+    with pytest.raises(EntityInvariantException, match='Hook failed'):
+        await network_repository.create_many(networks)
+    monkeypatch.undo()
+    assert all(network.persisted for network in networks)
+    networks[2].name = 'Renamed Hooked Network'
+    await network_repository.create_many(networks)
+    network_repository._identity_map.clear()
+    assert (await network_repository.get_by_uid(networks[2].uid)).name == (
+        'Renamed Hooked Network'
+    )
+    await network_repository.remove_many(networks)
+
+
+@pytest.mark.asyncio
+async def test_unit_of_work(
+    async_session_maker, network_repository, image_repository, node_repository
+):
+    """
+    Test whether a unit of work persists changes across repositories in one transaction
+    """
+    async with DDDUnitOfWork(async_session_maker):
+        network = await NetworkEntity(
+            name='UoW Network',
+            network='10.1.0.0',
+            netmask='255.255.255.0',
+            router='10.1.0.1',
+        ).save()
+        image = await ImageEntity('UoW Image', url='https://image.url/uow.img').save()
+        # The node is saved first, the unit of work must still insert it last
+        node = NodeEntity(name='UoW Node', network=network, image=image)
+        await node.save()
+        assert node.dirty
+        assert node.uid not in node_repository._identity_map
+    assert not node.dirty
+    assert not network.dirty
+    node_repository._identity_map.clear()
+    loaded = await node_repository.get_by_uid(node.uid)
+    assert loaded == node
+
+    loaded.name = 'Renamed UoW Node'
+    async with DDDUnitOfWork(async_session_maker):
+        await node_repository.remove(node)
+        await network_repository.remove(network)
+        await image_repository.remove(image)
+        assert len(await node_repository.get_many([node.uid], missing_ok=True)) == 1
+    network_repository._identity_map.clear()
+    with pytest.raises(EntityNotFoundException):
+        await network_repository.get_by_uid(network.uid)
+
+
+@pytest.mark.asyncio
+async def test_unit_of_work_empty(seed_networks, async_session_maker, monkeypatch):
+    """
+    Test whether an empty unit of work after loading entities runs no hooks and writes nothing
+    """
+    cache = DDDLRUCache()
+    repository = NetworkRepository(async_session_maker, cache=cache)
+    loaded = [await repository.get_by_uid(n.uid) for n in seed_networks]
+    assert not any(n.dirty for n in loaded)
+    versions = [
+        cache.version(repository._cache_key(NetworkModel, n.uid)) for n in loaded
+    ]
+    hooks = []
+
+    async def post_modify(self):
+        hooks.append(self)
+
+    monkeypatch.setattr(NetworkEntity, 'post_modify', post_modify)
+    pins = _primary_pins.get()
+    async with DDDUnitOfWork(async_session_maker):
+        pass
+    assert hooks == []
+    assert _primary_pins.get() is pins
+    assert [
+        cache.version(repository._cache_key(NetworkModel, n.uid)) for n in loaded
+    ] == versions
+
+
+@pytest.mark.asyncio
+async def test_unit_of_work_rollback(async_session_maker, network_repository):
+    """
+    Test whether a unit of work discards its changes when an exception is raised
+    """
+    network = NetworkEntity(
+        name='Rolled back Network',
+        network='10.2.0.0',
+        netmask='255.255.255.0',
+        router='10.2.0.1',
+    )
+    with pytest.raises(ValueError):
+        async with DDDUnitOfWork(async_session_maker):
+            await network.save()
+            raise ValueError('Abort')
+    assert network.dirty
+    with pytest.raises(EntityNotFoundException):
+        await network_repository.get_by_uid(network.uid)
+
+
+@pytest.mark.asyncio
+async def test_lru_identity_map(seed_nodes, node_repository):
+    """
+    Test whether a bounded identity map evicts and counts its hits, misses and evictions
+    """
+    identity_map = DDDLRUIdentityMap(max_size=2)
+    node_repository._identity_map = identity_map
+    for node in seed_nodes:
+        await node_repository.get_by_uid(node.uid)
+    assert len(identity_map) == 2
+    assert seed_nodes[0].uid not in identity_map
+    assert identity_map.stats.misses == 3
+    assert identity_map.stats.evictions == 1
+    await node_repository.get_by_uid(seed_nodes[2].uid)
+    assert identity_map.stats.hits == 1
+    assert identity_map.stats.hit_ratio == 0.25
+
+    loaded = await node_repository.get_by_uid(seed_nodes[2].uid)
+    await node_repository.remove(loaded)
+    assert seed_nodes[2].uid not in identity_map
+    await node_repository.create(loaded)
+
+
+@pytest.mark.asyncio
+async def test_save_evicted_entity(async_session_maker):
+    """
+    Test whether entities evicted from a bounded identity map are still updated, not inserted
+    """
+    repository = NetworkRepository(
+        async_session_maker, identity_map=DDDLRUIdentityMap(max_size=2)
+    )
+    networks = [
+        await NetworkEntity(
+            name=f'Evicted Network {i}',
+            network=f'10.13.{i}.0',
+            netmask='255.255.255.0',
+            router=f'10.13.{i}.1',
+        ).save()
+        for i in range(0, 3)
+    ]
+    assert networks[0].uid not in repository.identity_map
+    networks[0].name = 'Renamed Evicted Network'
+    await networks[0].save()
+    assert networks[0].uid in repository.identity_map
+
+    # Dirty entities stay in the identity map for the unit of work to find them
+    networks[2].name = 'Renamed In Unit Of Work'
+    async with DDDUnitOfWork(async_session_maker):
+        await repository.get_by_uid(networks[1].uid)
+        assert networks[2].uid in repository.identity_map
+    repository.identity_map.clear()
+    assert [(await repository.get_by_uid(n.uid)).name for n in networks] == [
+        'Renamed Evicted Network',
+        'Evicted Network 1',
+        'Renamed In Unit Of Work',
+    ]
+    await repository.remove_many(networks)
+
+
+@pytest.mark.asyncio
+async def test_weak_identity_map(async_session_maker, seed_networks):
+    """
+    Test whether a weak identity map drops entities nobody refers to anymore
+    """
+    repository = NetworkRepository(
+        async_session_maker, identity_map=DDDWeakIdentityMap()
+    )
+    loaded = await repository.get_by_uid(seed_networks[0].uid)
+    assert repository.identity_map.lookup(seed_networks[0].uid) is loaded
+    del loaded
+    gc.collect()
+    assert seed_networks[0].uid not in repository.identity_map
+    assert repository.identity_map.stats.evictions == 1
+
+
+@pytest.mark.asyncio
+async def test_get_by_uid_single_flight(seed_nodes, node_repository, monkeypatch):
+    """
+    Test whether concurrent misses for the same uid are coalesced into a single load
+    """
+    loads = 0
+    from_model = NodeRepository.from_model
+
+    async def counting_from_model(cls, model, *args, **kwargs):
+        nonlocal loads
+        loads += 1
+        return await from_model(model, *args, **kwargs)
+
+    monkeypatch.setattr(NodeRepository, 'from_model', classmethod(counting_from_model))
+    node_repository._identity_map.clear()
+    loaded = await asyncio.gather(
+        *[node_repository.get_by_uid(seed_nodes[0].uid) for _ in range(0, 50)]
+    )
+    assert loads == 1
+    assert all(node is loaded[0] for node in loaded)
+
+    missing_uid = uuid.uuid4()
+    missing = await asyncio.gather(
+        *[node_repository.get_by_uid(missing_uid) for _ in range(0, 5)],
+        return_exceptions=True,
+    )
+    assert all(isinstance(e, EntityNotFoundException) for e in missing)
+    assert len(node_repository._in_flight) == 0
+
+
+@pytest.mark.asyncio
+async def test_modify_changed_columns(seed_nodes, node_repository, async_session_maker):
+    """
+    Test whether modify only updates the changed columns without reading the row first
+    """
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    engine = async_session_maker.kw['bind'].sync_engine
+    sqlalchemy.event.listen(engine, 'before_cursor_execute', record)
+    try:
+        node = await node_repository.get_by_uid(seed_nodes[0].uid)
+        statements.clear()
+        node.name = 'Renamed Node'
+        await node.save()
+        assert len(statements) == 1
+        assert statements[0].startswith('UPDATE nodes SET name=?')
+
+        statements.clear()
+        await node_repository.modify(node)
+        assert len(statements) == 0
+    finally:
+        sqlalchemy.event.remove(engine, 'before_cursor_execute', record)
+    node_repository._identity_map.clear()
+    assert (await node_repository.get_by_uid(node.uid)).name == 'Renamed Node'
+
+
+@pytest.mark.asyncio
+async def test_shared_hydration(
+    seed_nodes, seed_networks, node_repository, network_repository
+):
+    """
+    Test whether related aggregates are shared between the entities of a single load
+    """
+    network_repository._identity_map.clear()
+    node_repository._identity_map.clear()
+    nodes = await node_repository.get_many([node.uid for node in seed_nodes])
+    assert all(node.network is nodes[0].network for node in nodes)
+    assert all(node.image is nodes[0].image for node in nodes)
+    assert await network_repository.get_by_uid(seed_networks[0].uid) is nodes[0].network
+
+    listed = await node_repository.list()
+    assert all(node.network is nodes[0].network for node in listed)
+
+
+@pytest.mark.asyncio
+async def test_remove_many(network_repository):
+    """
+    Test whether many entities can be removed in a single transaction
+    """
+    networks = await network_repository.create_many(
+        [
+            NetworkEntity(
+                name=f'Removed Network {i}',
+                network=f'10.3.{i}.0',
+                netmask='255.255.255.0',
+                router=f'10.3.{i}.1',
+            )
+            for i in range(0, 20)
+        ]
+    )
+    await network_repository.remove_many(networks)
+    assert not any(
+        network.uid in network_repository.identity_map for network in networks
+    )
+    assert (
+        await network_repository.get_many(
+            [network.uid for network in networks], missing_ok=True
+        )
+        == []
+    )
+    with pytest.raises(EntityNotFoundException):
+        await network_repository.remove_many(networks[0:1])
+
+
+def test_uuid7():
+    """
+    Test whether generated identifiers are version 7 and ordered by time
+    """
+    first = uuid7()
+    uids = [uuid7() for _ in range(0, 1000)]
+    assert all(uid.version == 7 for uid in uids)
+    assert len(set(uids)) == len(uids)
+    assert first.bytes[0:6] <= uids[-1].bytes[0:6]
+
+
+@pytest.mark.asyncio
+async def test_binary_uids(tmp_path, async_session_maker, seed_networks):
+    """
+    Test whether identifiers can be stored as binary and migrated from string storage
+    """
+    engine = sqlalchemy.ext.asyncio.create_async_engine(
+        f'sqlite+aiosqlite:///{tmp_path.joinpath("binary.sqlite")}'
+    )
+    use_binary_uids(engine)
+    copied = await migrate_uids(
+        DDDModel.metadata, async_session_maker.kw['bind'], engine
+    )
+    assert copied['networks'] == 3
+    try:
+        async with engine.connect() as conn:
+            stored = (
+                await conn.execute(sqlalchemy.text('SELECT uid FROM networks'))
+            ).scalars()
+            assert all(isinstance(uid, bytes) and len(uid) == 16 for uid in stored)
+        repository = NetworkRepository(
+            sqlalchemy.ext.asyncio.async_sessionmaker(engine, expire_on_commit=False)
+        )
+        loaded = await repository.get_by_uid(seed_networks[0].uid)
+        assert loaded == seed_networks[0]
+        network = await NetworkEntity(
+            name='Binary Network',
+            network='10.4.0.0',
+            netmask='255.255.255.0',
+            router='10.4.0.1',
+        ).save()
+        repository._identity_map.clear()
+        assert await repository.get_by_uid(network.uid) == network
+        first = await repository.page(limit=2, order_by='name')
+        second = await repository.page(limit=2, order_by='name', cursor=first.cursor)
+        assert len(first.entities) + len(second.entities) == 4
+    finally:
+        await engine.dispose()
+
+
+@pytest.mark.asyncio
+async def test_upgrade_schema(tmp_path):
+    """
+    Test whether databases created before columns were added are upgraded in place
+    """
+    path = tmp_path.joinpath('old.sqlite')
+    uid = str(uuid7())
+    with sqlite3.connect(path) as conn:
+        conn.execute(
+            'CREATE TABLE networks (uid VARCHAR(32) PRIMARY KEY, name VARCHAR(64), '
+            'network VARCHAR(15), netmask VARCHAR(15), router VARCHAR(15))'
+        )
+        conn.execute(
+            'INSERT INTO networks VALUES (?, ?, ?, ?, ?)',
+            (uid, 'Old Network', '10.5.0.0', '255.255.0.0', '10.5.0.1'),
+        )
+    conn.close()
+    engine = sqlalchemy.ext.asyncio.create_async_engine(f'sqlite+aiosqlite:///{path}')
+    try:
+        added = await upgrade_schema(DDDModel.metadata, engine)
+        assert sorted(added['networks']) == [
+            'network_end',
+            'network_start',
+            'revision',
+            'updated_at',
+        ]
+        assert await upgrade_schema(DDDModel.metadata, engine) == {}
+        async with engine.connect() as conn:
+            indexes = await conn.run_sync(
+                lambda c: {
+                    i['name'] for i in sqlalchemy.inspect(c).get_indexes('networks')
+                }
+            )
+        assert 'ix_networks_network_start_network_end' in indexes
+
+        repository = NetworkRepository(
+            sqlalchemy.ext.asyncio.async_sessionmaker(engine, expire_on_commit=False),
+            track_revisions=True,
+        )
+        assert await repository.containing('10.5.1.1') == []
+        assert await repository.backfill_ranges() == 1
+        assert [n.name for n in await repository.containing('10.5.1.1')] == [
+            'Old Network'
+        ]
+        assert await repository.backfill_ranges() == 0
+        network = await NetworkEntity(
+            name='New Network',
+            network='10.6.0.0',
+            netmask='255.255.255.0',
+            router='10.6.0.1',
+        ).save()
+        changes = [change async for change in repository.changes_since(0)]
+        assert [(change.revision, change.entity.name) for change in changes] == [
+            (0, 'Old Network'),
+            (1, 'New Network'),
+        ]
+        assert changes[1].uid == network.uid
+        assert [c async for c in repository.changes_since(1)] == []
+    finally:
+        await engine.dispose()
+
+
+@pytest.fixture(params=['lru', 'sqlite'])
+def cache(request, tmp_path):
+    if request.param == 'lru':
+        yield DDDLRUCache(ttl=60)
+    else:
+        cache = DDDSQLiteCache(tmp_path.joinpath('cache.sqlite'), ttl=60)
+        yield cache
+        cache.close()
+
+
+def test_cache_versioning(cache):
+    """
+    Test whether values loaded before an invalidation are never cached
+    """
+    version = cache.version('networks:1')
+    cache.invalidate('networks:1')
+    assert not cache.put('networks:1', version, {'name': 'Stale'})
+    assert cache.get('networks:1') is None
+    version = cache.version('networks:1')
+    assert cache.put('networks:1', version, {'name': 'Current'})
+    assert cache.get('networks:1') == {'name': 'Current'}
+    cache.invalidate('networks:1')
+    assert cache.get('networks:1') is None
+
+
+@pytest.mark.asyncio
+async def test_second_level_cache(cache, seed_nodes, async_session_maker, monkeypatch):
+    """
+    Test whether repositories sharing a cache serve each other and invalidate on writes
+    """
+    warm = NodeRepository(async_session_maker, cache=cache)
+    await warm.get_by_uid(seed_nodes[0].uid)
+    assert cache.stats.hits == 0
+
+    # The node is now cached, its network and image get cached on this load
+    await NodeRepository(async_session_maker, cache=cache).get_by_uid(seed_nodes[0].uid)
+    assert cache.stats.hits == 1
+
+    cold = NodeRepository(async_session_maker, cache=cache)
+    loaded = await cold.get_by_uid(seed_nodes[0].uid)
+    assert cache.stats.hits == 4
+    assert loaded == seed_nodes[0]
+    assert loaded.network == seed_nodes[0].network
+
+    loaded.name = 'Cached Node'
+    await cold.modify(loaded)
+    fresh = NodeRepository(async_session_maker, cache=cache)
+    assert (await fresh.get_by_uid(seed_nodes[0].uid)).name == 'Cached Node'
+    loaded.name = seed_nodes[0].name
+    await cold.modify(loaded)
+
+    # Caches blocking on I/O are called off the event loop
+    threads = set()
+    for name in ('get', 'version', 'put', 'invalidate_many'):
+
+        def record(*args, method=getattr(cache, name)):
+            threads.add(threading.get_ident())
+            return method(*args)
+
+        monkeypatch.setattr(cache, name, record)
+    await NodeRepository(async_session_maker, cache=cache).get_by_uid(seed_nodes[1].uid)
+    await cold.modify(loaded)
+    assert len(threads) > 0
+    assert (threading.get_ident() in threads) != cache.blocking
+
+
+@pytest_asyncio.fixture
+async def replica_session_maker(tmp_path):
+    engine = sqlalchemy.ext.asyncio.create_async_engine(
+        f'sqlite+aiosqlite:///{tmp_path.joinpath("replica.sqlite")}'
+    )
+    async with engine.begin() as conn:
+        await conn.run_sync(DDDModel.metadata.create_all)
+    yield sqlalchemy.ext.asyncio.async_sessionmaker(engine, expire_on_commit=False)
+    await engine.dispose()
+
+
+@pytest.mark.asyncio
+async def test_read_replicas(seed_networks, async_session_maker, replica_session_maker):
+    """
+    Test whether reads are routed to replicas unless the caller must read its writes
+    """
+    repository = NetworkRepository(
+        async_session_maker, read_session_makers=[replica_session_maker]
+    )
+
+    async def read_elsewhere():
+        # A caller that did not write, such as another request
+        return len(
+            await asyncio.create_task(repository.list(), context=contextvars.Context())
+        )
+
+    # The replica is empty, so finding nothing proves the read went there
+    assert await read_elsewhere() == 0
+    async with DDDUnitOfWork(async_session_maker):
+        assert len(await repository.list()) == 3
+
+    async def write_then_read():
+        created = await repository.create(
+            NetworkEntity(
+                name='Replicated Network',
+                network='10.5.0.0',
+                netmask='255.255.255.0',
+                router='10.5.0.1',
+            )
+        )
+        other = NetworkRepository(
+            async_session_maker, read_session_makers=[replica_session_maker]
+        )
+        return created, len(await repository.list()), len(await other.list())
+
+    # The writer reads its writes through any repository on the primary, others do not wait
+    network, seen, seen_by_other = await asyncio.create_task(write_then_read())
+    assert (seen, seen_by_other) == (4, 4)
+    assert await read_elsewhere() == 0
+    await repository.remove(network)
+
+
+@pytest.mark.asyncio
+async def test_find_and_count(seed_nodes, seed_networks, node_repository):
+    """
+    Test whether specifications find and count entities in the database
+    """
+    on_network = Equals('network_uid', seed_networks[0]) & Equals('cluster_uid', None)
+    assert len(await node_repository.find(on_network)) == 3
+    assert await node_repository.count(on_network) == 3
+    assert await node_repository.count(Equals('network_uid', seed_networks[1])) == 0
+
+    found = await node_repository.find(
+        In('name', ['Node-0', 'Node-2']) | Prefix('name', 'Node-1')
+    )
+    assert sorted(node.name for node in found) == ['Node-0', 'Node-1', 'Node-2']
+    assert found[0] is await node_repository.get_by_uid(found[0].uid)
+    assert len(await node_repository.find(Prefix('name', 'Node-'), limit=2)) == 2
+    assert await node_repository.count(Prefix('name', 'node-')) == 0
+    assert await node_repository.count(Prefix('name', 'Node_')) == 0
+    assert await node_repository.count(Prefix('name', '')) == 3
+    assert await node_repository.count() == 3
+    many = [f'Node-{i}' for i in range(0, 2 * node_repository.chunk_size + 1)]
+    assert await node_repository.count(In('name', many)) == 3
+    assert await node_repository.count(In('name', [])) == 0
+    with pytest.raises(
+        EntityInvariantException, match='\\[400\\] NodeModel has no column foo'
+    ):
+        await node_repository.find(Equals('foo', 'bar'))
+
+
+def test_prefix_range():
+    """
+    Test whether prefixes compile to a range instead of LIKE, so that indexes can be used
+    """
+    compiled = str(
+        Prefix('name', 'Node-')
+        .compile(NetworkModel)
+        .compile(compile_kwargs={'literal_binds': True})
+    )
+    assert compiled == "networks.name >= 'Node-' AND networks.name < 'Node.'"
+    chunked = In('name', [str(i) for i in range(0, NetworkRepository.chunk_size + 1)])
+    assert str(chunked.compile(NetworkModel)).count(' IN ') == 2
+
+
+@pytest.mark.asyncio
+async def test_network_containment(seed_networks, network_repository):
+    """
+    Test whether networks can be found by the addresses they contain
+    """
+    assert await network_repository.containing('172.16.1.5') == [seed_networks[1]]
+    assert await network_repository.containing('172.17.0.1') == []
+    overlapping = await network_repository.overlapping('172.16.0.0/23')
+    assert sorted(n.name for n in overlapping) == ['Host-only Network', 'NAT Network']
+    assert len(await network_repository.overlapping('172.16.0.0/16')) == 3
+
+    supernet = await NetworkEntity(
+        name='Supernet',
+        network='172.16.0.0',
+        netmask='255.255.0.0',
+        router='172.16.0.254',
+    ).save()
+    assert await network_repository.containing('172.16.2.9') == [
+        seed_networks[2],
+        supernet,
+    ]
+    await network_repository.remove(supernet)
+    with pytest.raises(EntityInvariantException, match='\\[400\\] Invalid address'):
+        await network_repository.containing('not an address')
+
+    # Looked up by network address, not by scanning every network starting before the address
+    query = sqlalchemy.select(NetworkModel).where(
+        NetworkRepository._containing(int(ipaddress.IPv4Address('172.16.2.9')))
+    )
+    async with network_repository.session_makers[0]() as session:
+        plan = (
+            await session.execute(
+                sqlalchemy.text(
+                    'EXPLAIN QUERY PLAN '
+                    + str(query.compile(compile_kwargs={'literal_binds': True}))
+                )
+            )
+        ).all()
+    assert any('network_start=?' in row[-1] for row in plan)
+
+
+@pytest.mark.asyncio
+async def test_lazy_cluster_nodes(seed_nodes, node_repository, cluster_repository):
+    """
+    Test whether cluster members are loaded lazily from the nodes
+    """
+    cluster = await ClusterEntity(name='Lazy Cluster').save()
+    for node in seed_nodes[0:2]:
+        cluster.add_node(node)
+        await node_repository.modify(node)
+        await cluster.save()
+    cluster.add_node(seed_nodes[0])
+    assert len(cluster.nodes) == 2
+
+    cluster_repository._identity_map.clear()
+    node_repository._identity_map.clear()
+    loaded = await cluster_repository.get_by_uid(cluster.uid)
+    assert not loaded.nodes.loaded
+    assert seed_nodes[0] in loaded.nodes
+    assert seed_nodes[2] not in loaded.nodes
+    with pytest.raises(
+        EntityInvariantException,
+        match='\\[400\\] The nodes of this cluster have not been loaded',
+    ):
+        len(loaded.nodes)
+    members = [node async for node in loaded.nodes]
+    assert sorted(node.name for node in members) == ['Node-0', 'Node-1']
+    assert all(node.cluster is loaded for node in members)
+    assert loaded.nodes.loaded
+    assert loaded.nodes == cluster.nodes
+
+    # Nodes can be added to a loaded cluster without loading its members first
+    cluster_repository._identity_map.clear()
+    node_repository._identity_map.clear()
+    loaded = await cluster_repository.get_by_uid(cluster.uid)
+    assert not loaded.dirty
+    node = await node_repository.get_by_uid(seed_nodes[2].uid)
+    loaded.add_node(node)
+    assert not loaded.nodes.loaded
+    await node_repository.modify(node)
+    await loaded.save()
+    cluster_repository._identity_map.clear()
+    node_repository._identity_map.clear()
+    reloaded = await cluster_repository.get_by_uid(cluster.uid)
+    members = [node async for node in reloaded.nodes]
+    assert sorted(node.name for node in members) == ['Node-0', 'Node-1', 'Node-2']
+
+
+class InMemoryProducer:
+    """
+    An in-process stand-in for a transactional Kafka producer
+    """
+
+    def __init__(self, fail: bool = False) -> None:
+        self.fail = fail
+        self.pending = []
+        self.committed = []
+        self.transactions = 0
+
+    def init_transactions(self):
+        pass
+
+    def begin_transaction(self):
+        self.pending = []
+
+    def send(self, topic, value, key):
+        if self.fail:
+            raise RuntimeError('Broker unavailable')
+        self.pending.append((topic, key, json.loads(value)))
+
+    def commit_transaction(self):
+        self.committed.extend(self.pending)
+        self.transactions += 1
+
+    def abort_transaction(self):
+        self.pending = []
+
+
+@pytest.mark.asyncio
+async def test_outbox(async_session_maker):
+    """
+    Test whether changes are recorded in the outbox and relayed in batched transactions
+    """
+    repository = NetworkRepository(
+        async_session_maker, outbox=DDDOutbox(topic='networks')
+    )
+    network = await repository.create(
+        NetworkEntity(
+            name='Outbox Network',
+            network='10.6.0.0',
+            netmask='255.255.255.0',
+            router='10.6.0.1',
+        )
+    )
+    network.name = 'Renamed Outbox Network'
+    await repository.modify(network)
+    await repository.modify(network)  # Nothing changed, so no event
+    await repository.remove(network)
+
+    failing = DDDOutboxRelay(async_session_maker, InMemoryProducer(fail=True))
+    with pytest.raises(RuntimeError):
+        await failing.drain()
+
+    producer = InMemoryProducer()
+    relay = DDDOutboxRelay(async_session_maker, producer, batch_size=2)
+    assert await relay.drain() == 3
+    assert producer.transactions == 2
+    assert [event['event'] for _, _, event in producer.committed] == [
+        'created',
+        'modified',
+        'removed',
+    ]
+    topic, key, event = producer.committed[1]
+    assert topic == 'networks'
+    assert key == str(network.uid).encode('utf-8')
+    assert event['values']['name'] == 'Renamed Outbox Network'
+    async with async_session_maker() as session:
+        assert len((await session.execute(sqlalchemy.select(outbox_table))).all()) == 0
+
+
+@pytest.mark.asyncio
+async def test_outbox_late_commit(async_session_maker, generics_db):
+    """
+    Test whether events committed with a lower id while a batch is published are kept
+    """
+    event = {'topic': 'late', 'key': 'k', 'payload': '{}', 'created': 0.0}
+    async with async_session_maker() as session, session.begin():
+        await session.execute(
+            sqlalchemy.insert(outbox_table), [{'id': 10, **event}, {'id': 20, **event}]
+        )
+    producer = InMemoryProducer()
+    relay = DDDOutboxRelay(async_session_maker, producer)
+    publish = relay._publish
+
+    def publish_while_committing(rows):
+        publish(rows)
+        with sqlite3.connect(generics_db) as conn:
+            conn.execute(
+                'INSERT INTO outbox (id, topic, key, payload, created) '
+                "VALUES (15, 'late', 'k', '{}', 0.0)"
+            )
+
+    relay._publish = publish_while_committing
+    assert await relay.drain_once() == 2
+    async with async_session_maker() as session:
+        remaining = await session.scalars(sqlalchemy.select(outbox_table.c.id))
+        assert remaining.all() == [15]
+    relay._publish = publish
+    assert await relay.drain() == 1
+    assert len(producer.committed) == 3
+
+
+@pytest.mark.asyncio
+async def test_changes_since(seed_networks, async_session_maker):
+    """
+    Test whether the change feed reports only what changed after a watermark
+    """
+    with pytest.raises(DDDException, match='does not track revisions'):
+        await NetworkRepository(async_session_maker).watermark()
+    network_repository = NetworkRepository(async_session_maker, track_revisions=True)
+    # The seed networks were written without revisions, so they are only reported for 0
+    legacy = [c async for c in network_repository.changes_since(0)]
+    assert [(c.uid, c.revision) for c in legacy] == sorted(
+        (n.uid, 0) for n in seed_networks
+    )
+
+    created = await network_repository.create(
+        NetworkEntity(
+            name='Changed Network',
+            network='10.7.0.0',
+            netmask='255.255.255.0',
+            router='10.7.0.1',
+        )
+    )
+    watermark = await network_repository.watermark()
+    assert [c async for c in network_repository.changes_since(watermark)] == []
+    seed_networks[1].name = 'Renamed NAT Network'
+    await seed_networks[1].save()
+    seed_networks[1].name = 'NAT Network'
+    await seed_networks[1].save()
+    await network_repository.remove(created)
+
+    changes = [c async for c in network_repository.changes_since(watermark)]
+    assert [c.revision for c in changes] == sorted(c.revision for c in changes)
+    assert [(c.uid, c.removed) for c in changes] == [
+        (seed_networks[1].uid, False),
+        (created.uid, True),
+    ]
+    assert changes[0].entity == seed_networks[1]
+    assert changes[-1].revision == await network_repository.watermark()
+    all_changes = [c async for c in network_repository.changes_since(0)]
+    assert {c.uid for c in all_changes} >= {n.uid for n in seed_networks}
+
+
+@pytest.mark.asyncio
+async def test_group_commit(async_session_maker):
+    """
+    Test whether concurrent saves are merged into one transaction and failures stay per entity
+    """
+    repository = NetworkRepository(
+        async_session_maker, group_commit=DDDGroupCommit(window=0.05)
+    )
+    gone = await NetworkEntity(
+        name='Gone Network',
+        network='10.8.0.0',
+        netmask='255.255.255.0',
+        router='10.8.0.1',
+    ).save()
+    async with async_session_maker() as session, session.begin():
+        await session.execute(
+            sqlalchemy.delete(NetworkModel).where(NetworkModel.uid == str(gone.uid))
+        )
+    gone.name = 'Renamed Gone Network'
+    networks = [
+        NetworkEntity(
+            name=f'Grouped Network {i}',
+            network=f'10.9.{i}.0',
+            netmask='255.255.255.0',
+            router=f'10.9.{i}.1',
+        )
+        for i in range(0, 5)
+    ]
+
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    engine = async_session_maker.kw['bind'].sync_engine
+    sqlalchemy.event.listen(engine, 'before_cursor_execute', record)
+    try:
+        results = await asyncio.gather(
+            *[network.save() for network in networks], return_exceptions=True
+        )
+    finally:
+        sqlalchemy.event.remove(engine, 'before_cursor_execute', record)
+    assert results == networks
+    assert len([s for s in statements if s.startswith('INSERT INTO networks')]) == 1
+
+    for network in networks:
+        network.name = f'Renamed {network.name}'
+    results = await asyncio.gather(
+        gone.save(),
+        *[network.save() for network in networks],
+        return_exceptions=True,
+    )
+    assert isinstance(results[0], EntityNotFoundException)
+    assert results[1:] == networks
+    repository._identity_map.clear()
+    assert [(await repository.get_by_uid(n.uid)).name for n in networks] == [
+        n.name for n in networks
+    ]
+    await repository.remove_many(networks)
+
+
+@pytest.mark.asyncio
+async def test_group_commit_partial_failure(async_session_maker, tmp_path, monkeypatch):
+    """
+    Test whether a failing session maker or post hook only fails the callers it concerns
+    """
+    broken = sqlalchemy.ext.asyncio.create_async_engine(
+        f'sqlite+aiosqlite:///{tmp_path}/broken.sqlite'
+    )
+    group_commit = DDDGroupCommit(window=0.05)
+    repository = NetworkRepository(async_session_maker, group_commit=group_commit)
+    ImageRepository(
+        sqlalchemy.ext.asyncio.async_sessionmaker(broken), group_commit=group_commit
+    )
+    created = []
+    post_create = NetworkEntity.post_create
+
+    async def failing_post_create(self):
+        created.append(self)
+        if self.name == 'Failing Hook Network':
+            raise EntityInvariantException(code=400, msg='Hook failed')
+        await post_create(self)
+
+    monkeypatch.setattr(NetworkEntity, 'post_create', failing_post_create)
+    networks = [
+        NetworkEntity(
+            name=name,
+            network=f'10.14.{i}.0',
+            netmask='255.255.255.0',
+            router=f'10.14.{i}.1',
+        )
+        for i, name in enumerate(['Network A', 'Failing Hook Network', 'Network C'])
+    ]
+    results = await asyncio.gather(
+        *[n.save() for n in networks],
+        ImageEntity('Unstorable Image', url='https://image.url/x.img').save(),
+        return_exceptions=True,
+    )
+    assert results[0] is networks[0] and results[2] is networks[2]
+    assert isinstance(results[1], EntityInvariantException)
+    assert isinstance(results[3], DDDException)
+    assert sorted(n.name for n in created) == sorted(n.name for n in networks)
+    repository._identity_map.clear()
+    assert [(await repository.get_by_uid(n.uid)).name for n in networks] == [
+        n.name for n in networks
+    ]
+    await repository.remove_many(networks)
+
+    # A cancelled caller whose entity fails must not break the commit
+    cancelled = asyncio.create_task(
+        ImageEntity('Cancelled Image', url='https://image.url/y.img').save()
+    )
+    await asyncio.sleep(0)
+    cancelled.cancel()
+    group_commit._start()
+    await asyncio.gather(*group_commit._tasks)
+    assert cancelled.cancelled()
+    await broken.dispose()
+
+
+@pytest.mark.asyncio
+async def test_metrics(seed_nodes, async_session_maker):
+    """
+    Test whether repository operations are measured and exported
+    """
+    metrics = DDDMetrics()
+    repository = NodeRepository(async_session_maker, metrics=metrics)
+    await repository.get_by_uid(seed_nodes[0].uid)
+    await repository.get_by_uid(seed_nodes[0].uid)
+    with pytest.raises(EntityNotFoundException):
+        await repository.get_by_uid(uuid.uuid4())
+    nodes = await repository.list()
+
+    snapshot = metrics.snapshot()
+    get_by_uid = snapshot.operation('nodes', 'get_by_uid')
+    assert get_by_uid.latency.count == 3
+    assert get_by_uid.errors == 1
+    # The second call is served by the identity map
+    assert get_by_uid.queries.counts[0] == 1
+    assert get_by_uid.queries.sum >= 2
+    assert snapshot.operation('nodes', 'list').queries.count == 1
+    nodes_snapshot = snapshot.aggregate('nodes')
+    assert nodes_snapshot.rows_hydrated == 1 + len(nodes)
+    assert nodes_snapshot.identity_map_hits == 1
+    assert nodes_snapshot.identity_map_hit_ratio == pytest.approx(1 / 3)
+
+    text = metrics.export(DDDTextExporter())
+    assert '# TYPE ddd_operation_duration_seconds histogram' in text
+    assert (
+        'ddd_operation_duration_seconds_count{aggregate="nodes",operation="get_by_uid"} 3'
+        in text
+    )
+    assert (
+        'ddd_operation_errors_total{aggregate="nodes",operation="get_by_uid"} 1' in text
+    )
+    assert f'ddd_rows_hydrated_total{{aggregate="nodes"}} {1 + len(nodes)}' in text
+    metrics.reset()
+    assert metrics.snapshot().operations == []
+
+
+@pytest.mark.asyncio
+async def test_query_budget(seed_nodes, seed_networks, seed_images, query_budget):
+    """
+    Test whether listing nodes issues a constant number of statements and budgets are enforced
+    """
+    nodes = await NodeEntity.save_many(
+        [
+            NodeEntity(
+                name=f'Budget Node {i}',
+                network=seed_networks[i % 3],
+                image=seed_images[0],
+            )
+            for i in range(0, 100)
+        ]
+    )
+    NodeEntity.repository._identity_map.clear()
+    NetworkEntity.repository._identity_map.clear()
+    with query_budget(4) as recorder:
+        listed = await NodeEntity.repository.list()
+    assert len(listed) == 103
+    assert recorder.repeated() == {}
+
+    with pytest.raises(DDDQueryBudgetExceeded) as exc:
+        with query_budget(2):
+            for node in nodes[0:3]:
+                NodeEntity.repository._identity_map.pop(node.uid, None)
+                await NodeEntity.repository.get_by_uid(node.uid)
+    assert '3 x SELECT nodes.uid' in str(exc.value)
+    await NodeEntity.repository.remove_many(nodes)
+
+
+def test_query_shape():
+    assert DDDQueryRecorder.shape(
+        "SELECT * FROM nodes\n WHERE uid IN (?, ?, ?) AND name = 'x' LIMIT 10"
+    ) == DDDQueryRecorder.shape(
+        'SELECT * FROM nodes WHERE uid IN (?) AND name = ? LIMIT ?'
+    )
+
+
+def test_benchmark_compare():
+    baseline = [
+        {'scale': 10, 'operation': 'create', 'ops_per_second': 100.0},
+        {'scale': 10, 'operation': 'list', 'ops_per_second': 10.0},
+    ]
+    results = [
+        {'scale': 10, 'operation': 'create', 'ops_per_second': 95.0},
+        {'scale': 10, 'operation': 'list', 'ops_per_second': 5.0},
+        {'scale': 10, 'operation': 'remove', 'ops_per_second': 50.0},
+    ]
+    regressions = compare('repositories', results, baseline, tolerance=0.1)
+    assert [r['operation'] for r in regressions] == ['list']
+    assert results[0]['change'] == '-5.0%'
+    assert 'baseline' not in results[2]
+
+
+class ShardedNetworkRepository(DDDShardedRepository, NetworkRepository):
+    pass
+
+
+class ShardedNodeRepository(DDDShardedRepository, NodeRepository):
+    pass
+
+
+@pytest_asyncio.fixture
+async def sharded_session_makers(tmp_path):
+    engines = [
+        sqlalchemy.ext.asyncio.create_async_engine(
+            f'sqlite+aiosqlite:///{tmp_path}/shard-{i}.sqlite'
+        )
+        for i in range(0, 3)
+    ]
+    for engine in engines:
+        async with engine.begin() as conn:
+            await conn.run_sync(DDDModel.metadata.create_all)
+    yield [
+        sqlalchemy.ext.asyncio.async_sessionmaker(engine, expire_on_commit=False)
+        for engine in engines
+    ]
+    for engine in engines:
+        await engine.dispose()
+
+
+@pytest.mark.asyncio
+async def test_sharded_repository(sharded_session_makers):
+    """
+    Test whether aggregates are spread over the shards and fan-out reads merge them
+    """
+    repository = ShardedNetworkRepository(sharded_session_makers)
+    networks = [
+        NetworkEntity(
+            name=f'Sharded Network {i}',
+            network=f'10.10.{i}.0',
+            netmask='255.255.255.0',
+            router=f'10.10.{i}.1',
+        )
+        for i in range(0, 30)
+    ]
+    await networks[0].save()
+    await NetworkEntity.save_many(networks[1:])
+    for shard, session_maker in enumerate(sharded_session_makers):
+        async with session_maker() as session:
+            uids = set(
+                (await session.scalars(sqlalchemy.select(NetworkModel.uid))).all()
+            )
+        assert uids == {
+            str(n.uid) for n in networks if repository.shard(n.uid) == shard
+        }
+        assert 0 < len(uids) < len(networks)
+
+    assert await repository.count() == len(networks)
+    assert await repository.count(Prefix('name', 'Sharded Network 1')) == 11
+    assert len(await repository.find(Prefix('name', 'Sharded'), limit=5)) == 5
+    repository._identity_map.clear()
+    assert {n.uid for n in await repository.list()} == {n.uid for n in networks}
+    assert {n.uid async for n in repository.stream(chunk_size=4)} == {
+        n.uid for n in networks
+    }
+    repository._identity_map.clear()
+    fetched = await repository.get_by_uid(networks[5].uid)
+    assert fetched.name == 'Sharded Network 5'
+    assert await repository.get_many([n.uid for n in networks[0:10]]) == networks[0:10]
+
+    fetched.name = 'Renamed Sharded Network'
+    await fetched.save()
+    repository._identity_map.clear()
+    assert (await repository.get_by_uid(fetched.uid)).name == 'Renamed Sharded Network'
+    await fetched.remove()
+    await repository.remove_many(networks[6:])
+    assert await repository.count() == 5
+
+
+@pytest.mark.asyncio
+async def test_negative_cache(async_session_maker, query_budget):
+    """
+    Test whether repeated misses are answered from the negative cache until the uid is created
+    """
+    repository = NetworkRepository(
+        async_session_maker, negative_cache=DDDNegativeCache(ttl=60)
+    )
+    network = NetworkEntity(
+        name='Late Network',
+        network='10.11.0.0',
+        netmask='255.255.255.0',
+        router='10.11.0.1',
+    )
+    with pytest.raises(EntityNotFoundException):
+        await repository.get_by_uid(network.uid)
+    with query_budget(0):
+        for _ in range(0, 3):
+            with pytest.raises(EntityNotFoundException):
+                await repository.get_by_uid(network.uid)
+
+    await network.save()
+    assert network.uid not in repository._negative_cache
+    repository._identity_map.clear()
+    assert await repository.get_by_uid(network.uid) == network
+    await network.remove()
+
+
+@pytest.mark.asyncio
+async def test_membership_filter(seed_networks, async_session_maker, query_budget):
+    """
+    Test whether the membership filter rejects unknown uids without a query
+    """
+    with pytest.raises(DDDException, match='sole writer'):
+        await NetworkRepository(async_session_maker).rebuild_membership_filter()
+    network_repository = NetworkRepository(async_session_maker, sole_writer=True)
+    membership = await network_repository.rebuild_membership_filter()
+    assert all(n.uid in membership for n in seed_networks)
+    with query_budget(0):
+        for _ in range(0, 10):
+            with pytest.raises(EntityNotFoundException):
+                await network_repository.get_by_uid(uuid.uuid4())
+
+    network = await NetworkEntity(
+        name='Filtered Network',
+        network='10.12.0.0',
+        netmask='255.255.255.0',
+        router='10.12.0.1',
+    ).save()
+    network_repository._identity_map.clear()
+    assert await network_repository.get_by_uid(network.uid) == network
+    assert await network_repository.get_by_uid(seed_networks[0].uid) is not None
+    await network.remove()
+
+
+def test_bloom_filter():
+    membership = DDDBloomFilter(capacity=1000, error_rate=0.01)
+    uids = [uuid.uuid4() for _ in range(0, 1000)]
+    for uid in uids:
+        membership.add(uid)
+    assert all(uid in membership for uid in uids)
+    false_positives = sum(uuid.uuid4() in membership for _ in range(0, 10000))
+    assert false_positives < 300
+    assert membership.size_bytes < 1300
+
+
+@pytest.mark.asyncio
+async def test_project(seed_nodes, seed_networks, node_repository, query_budget):
+    """
+    Test whether projections select columns and related columns in a single query
+    """
+    node_repository._identity_map.clear()
+    with query_budget(1):
+        rows = await node_repository.project(
+            ('uid', 'name', 'network.name', 'cluster.name'),
+            specification=In('uid', [n.uid for n in seed_nodes]),
+        )
+    assert sorted((r.uid, r.name, r.network_name, r.cluster_name) for r in rows) == (
+        sorted((str(n.uid), n.name, seed_networks[0].name, None) for n in seed_nodes)
+    )
+    assert len(node_repository._identity_map) == 0
+
+    rows = await node_repository.project(('uid', 'image.url'), limit=1, as_dict=True)
+    assert list(rows[0].keys()) == ['uid', 'image.url']
+    with pytest.raises(EntityInvariantException):
+        await node_repository.project(('network.nonexistent',))
+    with pytest.raises(EntityInvariantException):
+        await node_repository.project(('owner.name',))
+
+
+@pytest.mark.asyncio
+async def test_sharded_nodes(
+    seed_networks, seed_images, cluster_repository, sharded_session_makers
+):
+    """
+    Test whether sharded nodes resolve their networks, images and clusters stored elsewhere
+    """
+    metrics = DDDMetrics()
+    repository = ShardedNodeRepository(sharded_session_makers, metrics=metrics)
+    cluster = await ClusterEntity(name='Sharded Cluster').save()
+    nodes = [
+        NodeEntity(
+            name=f'Sharded Node {i}',
+            network=seed_networks[i % 3],
+            image=seed_images[0],
+        )
+        for i in range(0, 9)
+    ]
+    for node in nodes:
+        await node.save()
+    assert len({repository.shard(n.uid) for n in nodes}) > 1
+    # Statements are counted whichever shard a node went to, none fall into the zero bucket
+    creates = metrics.snapshot().operation('nodes', 'create')
+    assert creates.queries.count == len(nodes)
+    assert creates.queries.counts[0] == 0
+
+    cluster.add_node(nodes[0])
+    await nodes[0].save()
+    await cluster.save()
+    repository.identity_map.clear()
+    cluster_repository.identity_map.clear()
+    listed = sorted(await repository.list(), key=lambda n: n.name)
+    assert [n.name for n in listed] == [n.name for n in nodes]
+    assert [n.network.uid for n in listed] == [n.network.uid for n in nodes]
+    assert listed[0].cluster.uid == cluster.uid
+    loaded = await repository.get_by_uid(nodes[4].uid)
+    assert loaded.image.uid == seed_images[0].uid
+    members = [node async for node in listed[0].cluster.nodes]
+    assert [n.uid for n in members] == [nodes[0].uid]
+
+    await repository.remove_many(nodes)
+    await cluster_repository.remove(cluster)